@@ -0,0 +1,664 @@
+# bench.py
+"""
+ヘッドレスのベンチマーク（ウィンドウは開かない）
+実行: python bench.py [all|micro|scenes] [--frames 120] [--repeat 5] [--compare baseline.json] [--threshold 0.25]
+  micro : 部品ごとの計測（合成方式・パーティクル・歩行グリッドなど）
+  scenes: 各シーンをスクリプト入力で決まったフレーム数だけ動かし、FPS・区間ごとの時間・割り当て数を出す
+  --compare に以前の出力（python bench.py scenes > baseline.json）を渡すと、遅くなったシーンを報告して終了コード 1 で終わる
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import tracemalloc
+import tempfile
+import subprocess
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import pygame
+import poke
+
+
+def _timeit(fn, frames: int) -> dict:
+    """fn を frames 回呼び、1フレームあたりの時間を返す"""
+    fn()  # ウォームアップ（キャッシュ作成など）
+    t0 = time.perf_counter()
+    for _ in range(frames):
+        fn()
+    total = time.perf_counter() - t0
+    return {"frames": frames, "ms_per_frame": total * 1000 / frames, "fps": frames / total}
+
+
+# ====== バトル画面の合成方式 ======
+def bench_battle_compose(screen: pygame.Surface, frames: int = 300) -> dict:
+    """旧方式（毎フレーム全画面SRCALPHAを確保して合成）と現方式（画面へ直接描画）の比較"""
+    W, H = screen.get_size()
+    bg, player_img, enemy_img = poke._load_battle_images((W, H))
+    player_rect = player_img.get_rect(bottomleft=(200, H - 50))
+    enemy_rect = enemy_img.get_rect(topleft=(W - 300, 120))
+    src = (player_rect.right - 20, player_rect.top + 40)
+    dst = (enemy_rect.left + 20, enemy_rect.top + 40)
+    effect = poke.FlamethrowerEffect(src, dst)
+    for _ in range(20):
+        effect.update()
+
+    def compose(target):
+        target.blit(bg, (0, 0))
+        target.blit(player_img, player_rect)
+        target.blit(enemy_img, enemy_rect)
+        pygame.draw.rect(target, (255, 0, 0), (80, H - 260, 200, 20))
+        pygame.draw.rect(target, (255, 0, 0), (W - 300, 80, 200, 20))
+        poke.draw_text(target, "たいあたり（ノーマル）！ 10ダメージ！", 80, H - 180, 26)
+        effect.draw(target)
+
+    def legacy():
+        temp = pygame.Surface((W, H), pygame.SRCALPHA)
+        compose(temp)
+        screen.blit(temp, (0, 0))
+
+    def direct():
+        compose(screen)
+
+    before = _timeit(legacy, frames)
+    after = _timeit(direct, frames)
+    return {
+        "before_temp_srcalpha": before,
+        "after_direct": after,
+        "speedup": before["ms_per_frame"] / after["ms_per_frame"],
+    }
+
+
+# ====== パーティクルエフェクト ======
+def bench_particles(screen: pygame.Surface, densities=(1, 10)) -> dict:
+    """かえんほうしゃ/みずでっぽうを最後まで再生し、1フレームあたりの update+draw 時間を測る"""
+    src, dst = (380, 390), (520, 160)
+    results = {}
+    for name, cls in (("flame", poke.FlamethrowerEffect), ("water", poke.WaterGunEffect)):
+        for density in densities:
+            effect = cls(src, dst, density=density)
+            frames, peak = 0, 0
+            t0 = time.perf_counter()
+            while effect.update():
+                effect.draw(screen)
+                frames += 1
+                peak = max(peak, len(getattr(effect, "flames", getattr(effect, "drops", ()))))
+            total = time.perf_counter() - t0
+            results[f"{name}_x{density}"] = {
+                "frames": frames,
+                "peak_particles": peak,
+                "ms_per_frame": total * 1000 / max(1, frames),
+            }
+    return results
+
+
+def bench_quality_tiers(screen: pygame.Surface) -> dict:
+    """かえんほうしゃ×2・みずでっぽう・でんこうせっかを重ねて再生し、画質の段ごとの1フレームの時間を測る"""
+    src, dst = (380, 390), (520, 160)
+    results = {}
+    for tier in poke.QUALITY_TIERS:
+        poke.PARTICLE_RNG = np.random.default_rng(0)
+        effects = [
+            poke.FlamethrowerEffect(src, dst, density=tier["particles"], smoke=tier["smoke"]),
+            poke.FlamethrowerEffect(dst, src, density=tier["particles"], smoke=tier["smoke"]),
+            poke.WaterGunEffect(src, dst, density=tier["particles"], passes=tier["passes"]),
+            poke.QuickAttackEffect(src, dst, passes=tier["passes"]),
+        ]
+        frames = []
+        while effects:
+            t0 = time.perf_counter()
+            effects = [e for e in effects if e.update()]
+            for e in effects:
+                e.draw(screen)
+            frames.append((time.perf_counter() - t0) * 1000)
+        a = np.array(frames)
+        results[tier["name"]] = {
+            "frames": len(a),
+            "ms_per_frame": float(a.mean()),
+            "p95_ms": float(np.percentile(a, 95)),
+        }
+    return results
+
+
+# ====== 浮遊ダメージ ======
+def bench_floating_numbers(screen: pygame.Surface, count: int = 300, frames: int = 60) -> dict:
+    """
+    count 個のダメージ表示を同時に流す。変更前の描き方（render_text の複製を持ち、毎フレーム set_alpha して blit）と、
+    グリフアトラスからの描画を比べる。寿命は両方で同じ値を使い、消えた表示は描かない
+    """
+    rng = random.Random(0)
+    specs = [(str(rng.randint(1, 99)), (rng.randint(0, 760), rng.randint(100, 560)), rng.randint(1, 60))
+             for _ in range(count)]
+
+    def run(draw):
+        nums = []
+        for text, pos, ttl in specs:
+            f = poke.FloatingNumber(text, pos)
+            f.ttl = ttl
+            nums.append(f)
+        drawn = 0
+        t0 = time.perf_counter()
+        for _ in range(frames):
+            nums = [f for f in nums if f.update()]
+            for f in nums:
+                draw(f)
+            drawn += len(nums)
+        return (time.perf_counter() - t0) * 1000 / frames, drawn
+
+    def legacy(f):
+        if f.surf is None:
+            f.surf = poke.render_text(f.text, poke.FLOAT_TEXT_SIZE, poke.FLOAT_TEXT_COLOR, f.antialias).copy()
+        f.surf.set_alpha(f.alpha)
+        screen.blit(f.surf, (f.x, f.y))
+
+    def atlas(f):
+        f.draw(screen)
+
+    # 文字のキャッシュ（render_text とアトラスの LRU）を温めてから測る
+    run(legacy)
+    run(atlas)
+    before, drawn = run(legacy)
+    after, _ = run(atlas)
+    return {
+        "numbers": count,
+        "draws": drawn,
+        "before_render_text_ms_per_frame": before,
+        "after_atlas_ms_per_frame": after,
+        "speedup": before / after,
+    }
+
+
+# ====== 歩行グリッド ======
+def bench_walkability() -> dict:
+    """歩行グリッドの計算（キャッシュなし）とディスクキャッシュからの読み込みの時間"""
+    bg = pygame.image.load("background.png").convert()
+    t0 = time.perf_counter()
+    grid = poke.compute_walkable_grid(bg)
+    cold = time.perf_counter() - t0
+    poke.WalkabilityMap.load("background.png")  # キャッシュを用意
+    t0 = time.perf_counter()
+    poke.WalkabilityMap.load("background.png")
+    warm = time.perf_counter() - t0
+    return {
+        "grid": list(grid.shape),
+        "walkable_ratio": float(grid.mean()),
+        "compute_ms": cold * 1000,
+        "cached_load_ms": warm * 1000,
+    }
+
+
+# ====== 縮小済みスプライトのキャッシュ ======
+_SPRITE_STARTUP = """
+import os, sys, time, json
+import pygame
+import poke
+
+def status_kb(field):
+    # /proc/self/status の VmRSS（今の常駐量）/ VmHWM（常駐量の山）。Linux 以外では None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def reset_peak():
+    # import で付いた山を消して、読み込み中の山だけを測る（/proc/self/clear_refs に 5。Linux 4.0 以降）
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+poke.CACHE_DIR = sys.argv[1]
+pygame.init()
+pygame.display.set_mode((poke.WINDOW_W, poke.WINDOW_H))
+rss0 = status_kb("VmRSS")
+peak_reset = reset_peak()
+t0 = time.perf_counter()
+bg_rect = pygame.Rect(0, 0, 1024, 1024)
+poke.Player(bg_rect); poke.Egg(bg_rect); poke.BossGroup()
+ms = (time.perf_counter() - t0) * 1000
+rss1, hwm = status_kb("VmRSS"), status_kb("VmHWM")
+print(json.dumps({"ms": ms,
+                  "rss_growth_kb": rss1 - rss0 if rss0 is not None else None,
+                  "peak_rss_growth_kb": hwm - rss0 if peak_reset and hwm is not None else None,
+                  "disk_hits": poke.ASSETS.disk_hits}))
+"""
+
+def bench_sprite_cache() -> dict:
+    """
+    プレイヤー/タマゴ/ボスの読み込みを、縮小キャッシュなし（初回）とあり（2回目）で別プロセス計測
+    メモリは読み込みの前後の常駐量（VmRSS）の差と、読み込み中の山（VmHWM をリセットしてから）の増え分
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name in ("cold", "warm"):
+            out = subprocess.run([sys.executable, "-c", _SPRITE_STARTUP, cache_dir],
+                                 capture_output=True, text=True, check=True, env=os.environ.copy())
+            results[name] = json.loads(out.stdout.strip().splitlines()[-1])
+    return results
+
+
+# ====== スプライトアトラス ======
+def bench_sprite_atlas(screen: pygame.Surface, frames: int = 200) -> dict:
+    """
+    マップ・バトルのスプライトを、1枚ずつの Surface とアトラスのページ（subsurface）で blit の時間とメモリを比べる
+    ゲームの ATLAS が使われていなくても、ここでは別に SpriteAtlas(enabled=True) を作って詰める
+    """
+    world = pygame.Rect(0, 0, 1024, 1024)
+    player = poke.Player(world)
+    separate = [player.down_img, player.left_img, player.right_img, poke.Egg(world).image,
+                poke.Partner("bench").image]
+    separate += [b.image for b in poke.BossGroup().bosses]
+    separate += [poke.atlas_sized(path, poke.BATTLE_SPRITE_SIZE) for path in ("player_poke.png", "enemy.png")]
+    separate = [s.copy() for s in separate]  # ゲームの ATLAS のページと画素を共有しないように
+    atlas = poke.SpriteAtlas(enabled=True)
+    packed = [atlas.add(f"sprite{i}", s) for i, s in enumerate(separate)]
+    positions = [((i * 97) % 600, (i * 53) % 400) for i in range(len(separate))]
+
+    def draw(surfs):
+        return lambda: screen.blits(list(zip(surfs, positions)), doreturn=False)
+
+    separate_bytes = sum(s.get_width() * s.get_height() * s.get_bytesize() for s in separate)
+    return {
+        "game_atlas_enabled": poke.ATLAS.enabled,
+        "atlas": atlas.stats(),
+        "separate_bytes": separate_bytes,
+        # ページの空き（詰め残し）のぶん、個別に持つより多く使う
+        "overhead_bytes": atlas.memory_bytes() - separate_bytes,
+        "separate": _timeit(draw(separate), frames),
+        "atlas_blit": _timeit(draw(packed), frames),
+    }
+
+
+# ====== タイプ相性表 ======
+def _legacy_type_multiplier(move_type: str, target_type: str) -> float:
+    """旧 get_type_multiplier（呼ぶたびに dict を作る）"""
+    advantage = {
+        "ほのお": {"みず": 0.5, "くさ": 2.0, "でんき": 1.0},
+        "みず": {"ほのお": 2.0, "でんき": 0.5, "くさ": 0.5},
+        "でんき": {"みず": 2.0, "ほのお": 1.0, "くさ": 1.0},
+        "くさ": {"みず": 2.0, "ほのお": 0.5, "でんき": 1.0},
+        "ノーマル": {},
+    }
+    if move_type in advantage and target_type in advantage[move_type]:
+        return advantage[move_type][target_type]
+    return 1.0
+
+
+def bench_type_chart(repeat: int = 2000) -> dict:
+    """全技×全ボスのダメージ表を、旧方式（1件ずつ関数呼び出し）と行列1回の計算で比べる"""
+    moves = poke.MOVES
+    targets = [type_ for _, _, type_, *_ in poke.BOSS_SPECS]
+    target_ids = poke.TYPE_CHART.ids(targets)
+
+    def legacy():
+        return [[int(base * _legacy_type_multiplier(mtype, t)) for t in targets]
+                for _, base, mtype, _ in moves]
+
+    def matrix():
+        return moves.damage_table(target_ids)
+
+    assert legacy() == matrix().tolist()
+    before = _timeit(legacy, repeat)
+    after = _timeit(matrix, repeat)
+    return {
+        "table": [len(moves), len(targets)],
+        "legacy_us": before["ms_per_frame"] * 1000,
+        "matrix_us": after["ms_per_frame"] * 1000,
+    }
+
+
+# ====== 空間ハッシュ ======
+class _Entity:
+    def __init__(self, rect: pygame.Rect):
+        self.rect = rect
+
+
+def bench_spatial_hash(counts=(10, 100, 1000, 5000), queries: int = 2000) -> dict:
+    """
+    エンティティ数を増やしながら、線形探索と SpatialHash.query の1回あたりの時間を比べる
+    密度は一定（数に合わせてマップを広げる）
+    """
+    rng = random.Random(0)
+    results = {}
+    for n in counts:
+        side = int((n ** 0.5) * 150)
+        entities = [_Entity(pygame.Rect(rng.randrange(side), rng.randrange(side), 60, 60)) for _ in range(n)]
+        grid = poke.SpatialHash()
+        for e in entities:
+            grid.insert(e)
+        probes = [pygame.Rect(rng.randrange(side), rng.randrange(side), 40, 40) for _ in range(queries)]
+
+        t0 = time.perf_counter()
+        linear_hits = [[e for e in entities if p.colliderect(e.rect)] for p in probes]
+        linear = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        grid_hits = [grid.query(p) for p in probes]
+        hashed = time.perf_counter() - t0
+        assert linear_hits == grid_hits
+        results[str(n)] = {
+            "linear_us": linear * 1e6 / queries,
+            "grid_us": hashed * 1e6 / queries,
+        }
+    return results
+
+
+# ====== チャンク分割マップ ======
+def bench_map_stream(screen: pygame.Surface, tiles: int = 4, frames: int = 600) -> dict:
+    """
+    background.png を tiles×tiles 枚並べた大きなマップを作り、カメラで端から端まで流した時の
+    チャンクの読み込み数・常駐メモリ・1フレームあたりの時間を測る（マップ全体を1枚で持つ場合と比較）
+    """
+    bg = pygame.image.load("background.png")
+    w, h = bg.get_size()
+    big = pygame.Surface((w * tiles, h * tiles))
+    for ty in range(tiles):
+        for tx in range(tiles):
+            big.blit(bg, (tx * w, ty * h))
+    full_bytes = big.get_bytesize() * big.get_width() * big.get_height()
+
+    saved_cache_dir = poke.CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        poke.CACHE_DIR = os.path.join(tmp, "cache")
+        path = os.path.join(tmp, "big_map.png")
+        pygame.image.save(big, path)
+        del big
+        try:
+            t0 = time.perf_counter()
+            poke.ChunkedMap.open(path)
+            cold = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            world = poke.ChunkedMap.open(path)
+            warm = time.perf_counter() - t0
+
+            # 左上から右下へ斜めにカメラを流す
+            camera = poke.Camera(screen.get_size(), world.world_rect)
+            end = (world.world_rect.width, world.world_rect.height)
+            peak = 0
+            t0 = time.perf_counter()
+            for i in range(frames):
+                target = pygame.Rect(end[0] * i // frames, end[1] * i // frames, 1, 1)
+                camera.follow(target)
+                world.draw(screen, camera)
+                peak = max(peak, world.stats()["resident_bytes"])
+            total = time.perf_counter() - t0
+        finally:
+            poke.CACHE_DIR = saved_cache_dir
+    return {
+        "world": list(world.world_rect.size),
+        "split_ms": cold * 1000,
+        "open_cached_ms": warm * 1000,
+        "ms_per_frame": total * 1000 / frames,
+        "peak_resident_bytes": peak,
+        "full_map_bytes": full_bytes,
+        **{k: v for k, v in world.stats().items() if k in ("loads", "evictions")},
+    }
+
+
+def run_micro() -> dict:
+    pygame.init()
+    screen = pygame.display.set_mode((poke.WINDOW_W, poke.WINDOW_H))
+    return {
+        "battle_compose": bench_battle_compose(screen),
+        "particles": bench_particles(screen),
+        "quality_tiers": bench_quality_tiers(screen),
+        "floating_numbers": bench_floating_numbers(screen),
+        "walkability": bench_walkability(),
+        "map_stream": bench_map_stream(screen),
+        "sprite_cache": bench_sprite_cache(),
+        "sprite_atlas": bench_sprite_atlas(screen),
+        "type_chart": bench_type_chart(),
+        "spatial_hash": bench_spatial_hash(),
+    }
+
+
+# ====== シーンごとのベンチマーク ======
+SCENE_FRAMES = 120
+SCENE_DT = 16  # 1フレームの経過時間（ms）。時計は使わずこの値で進める
+SCENE_REPEAT = 5  # 時間はこの回数測って一番速い回を採る（揺れを抑える）
+REGRESSION_THRESHOLD = 0.25  # ベースラインよりこの割合以上遅くなったら退行とみなす
+REGRESSION_MIN_MS = 0.25  # ただし差がこれ未満（60fps の1フレームの 1.5% ほど）なら揺れとして無視する
+
+# 歩きの入力：(キー, フレーム数) を繰り返す（ボスには届かない範囲）
+WALK_SCRIPT = [(pygame.K_RIGHT, 30), (pygame.K_UP, 15), (pygame.K_LEFT, 60), (pygame.K_DOWN, 15), (pygame.K_RIGHT, 30)]
+
+
+def _key(key: int, type_: int = pygame.KEYDOWN) -> pygame.event.Event:
+    return pygame.event.Event(type_, key=key)
+
+
+def _every(n: int, key: int):
+    """n フレームごとに key を1回押すスクリプト"""
+    return lambda i: [_key(key), _key(key, pygame.KEYUP)] if i % n == 0 else []
+
+
+def _walk(i: int) -> list:
+    period = sum(n for _, n in WALK_SCRIPT)
+    t = i % period
+    for j, (key, n) in enumerate(WALK_SCRIPT):
+        if t == 0:
+            prev = WALK_SCRIPT[j - 1][0]
+            return ([_key(prev, pygame.KEYUP)] if i else []) + [_key(key)]
+        if t < n:
+            return []
+        t -= n
+    return []
+
+
+class SceneBench:
+    """
+    Game を1つ作り、シーンを積み替えながら SceneStack.step にスクリプト入力を渡して動かす
+    静止画面も毎フレーム描き直させるので、FPS はそのシーンを描き続けた時の値になる
+    """
+    def __init__(self, frames: int = SCENE_FRAMES, repeat: int = SCENE_REPEAT, renderer: str = None):
+        poke.PRINT_STARTUP_TIMELINE = False
+        self.frames = frames
+        self.repeat = repeat
+        self.game = poke.Game(renderer=renderer)
+        self.stack = self.game.stack
+        self.screen = self.game.screen
+
+    def reset(self, mode: int, egg_phase: int = 1):
+        g = self.game
+        while len(self.stack.scenes) > 1:
+            self.stack.pop()
+        self.stack.keys.down.clear()
+        g.mode, g.egg_phase = mode, egg_phase
+        g.ensure_assets()
+        if g.player is not None:
+            g.player.place(poke.PLAYER_START)
+            g.camera.follow(g.player.rect)
+        g.sim = poke.FixedStep()
+        poke.QUALITY.lock(0)  # 画質の自動調整で測る内容が変わらないよう最高画質に固定
+        poke.seed_rngs(0)
+
+    def _drive(self, script):
+        for i in range(self.frames):
+            self.stack.pacer.request_redraw()
+            self.stack.step(script(i), SCENE_DT)
+            yield
+
+    def measure(self, setup, script) -> dict:
+        """
+        setup() で場面を作り script(i) の入力で frames フレーム動かす。時間は repeat 回のうち一番速い回
+        割り当ては別に1回 tracemalloc を付けて回し、ブロック数と量を出す（Python ヒープのみ。Surface の画素は SDL 側なので含まない）
+        """
+        setup()
+        for _ in self._drive(script):  # 文字や縮小画像のキャッシュを温める（計測しない）
+            pass
+        best = None
+        for _ in range(self.repeat):
+            setup()
+            poke.PROFILER = poke.Profiler(window=self.frames)
+            gc.collect()
+            t0 = time.perf_counter()
+            for _ in self._drive(script):
+                pass
+            total = time.perf_counter() - t0
+            if best is None or total < best[0]:
+                best = (total, poke.PROFILER.summary(), type(self.stack.top).__name__)
+        total, phases, end_scene = best
+
+        setup()
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        start = tracemalloc.get_traced_memory()[0]
+        peaks, blocks = [], []
+        prev = sys.getallocatedblocks()
+        for _ in self._drive(script):
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - start)
+            tracemalloc.reset_peak()
+            now = sys.getallocatedblocks()
+            blocks.append(now - prev)
+            prev = now
+        net = tracemalloc.get_traced_memory()[0] - start
+        own = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        diff = tracemalloc.take_snapshot().filter_traces(own).compare_to(before.filter_traces(own), "lineno")
+        tracemalloc.stop()
+        grown = sorted((st for st in diff if st.count_diff > 0), key=lambda st: -st.count_diff)
+        return {
+            "frames": self.frames,
+            "fps": self.frames / total,
+            "ms_per_frame": total * 1000 / self.frames,
+            "phases": {name: {"mean": st["mean"], "p50": st["p50"], "p95": st["p95"], "max": st["max"]}
+                       for name, st in phases.items()},
+            # new_blocks: 回し終えた時に増えていた割り当てブロックの数（スナップショットの差分）と、多い順の行
+            # blocks_per_frame: 1フレームで増えたブロック数（sys.getallocatedblocks の差。フレーム内で解放された分は含まない）
+            # peak_kb: 1フレーム中の一時的な割り当ての山（平均と最大）/ net_kb: 回し終えた時に増えていた量
+            "alloc": {"new_blocks": sum(st.count_diff for st in grown),
+                      "top_new_blocks": {f"{os.path.basename(st.traceback[0].filename)}:{st.traceback[0].lineno}":
+                                         st.count_diff for st in grown[:3]},
+                      "blocks_per_frame_mean": sum(blocks) / len(blocks), "blocks_per_frame_max": max(blocks),
+                      "peak_kb_mean": sum(peaks) / len(peaks) / 1024, "peak_kb_max": max(peaks) / 1024,
+                      "net_kb": net / 1024},
+            "end_scene": end_scene,
+        }
+
+    def battle(self, kind: str):
+        index = next(i for i, m in enumerate(poke.BATTLE_MOVES) if m[3] == kind)
+
+        def setup():
+            self.reset(poke.MODE_PLAY)
+            scene = poke.BattleScene(self.screen, "レッドボス", "ほのお")
+            scene.engine.player_hp = scene.engine.enemy_hp = 10 ** 9  # 決着させずに技を出し続ける
+            scene.selected = index
+            self.stack.push(scene)
+
+        def script(i):
+            top = self.stack.top
+            return [_key(pygame.K_RETURN)] if getattr(top, "turn", None) == "player" else []
+        return self.measure(setup, script)
+
+    def result(self, result: str):
+        def setup():
+            self.reset(poke.MODE_PLAY)
+            self.stack.push(poke.ResultScene(self.screen.get_size(), result))
+        return self.measure(setup, lambda i: [])
+
+    def inventory(self, tab: int):
+        def setup():
+            self.reset(poke.MODE_PLAY)
+            self.game.open_inventory()
+            self.stack.top.current_tab = tab
+        return self.measure(setup, _every(10, pygame.K_DOWN))
+
+    def run(self) -> dict:
+        g = self.game
+        results = {
+            "title": self.measure(lambda: self.reset(poke.MODE_TITLE), lambda i: []),
+            "select_egg": self.measure(lambda: self.reset(poke.MODE_SELECT, 0), lambda i: []),
+            "select_hatched": self.measure(lambda: self.reset(poke.MODE_SELECT, 1), lambda i: []),
+            "overworld_walk": self.measure(lambda: self.reset(poke.MODE_PLAY), _walk),
+        }
+        for kind in ("tackle", "quick", "flame", "water"):
+            results[f"battle_{kind}"] = self.battle(kind)
+        results["result_win"] = self.result("win")
+        results["result_lose"] = self.result("lose")
+
+        def pet():
+            self.reset(poke.MODE_PLAY)
+            g.open_pet()
+        results["pet"] = self.measure(pet, lambda i: [_key(pygame.K_a)] if i % 20 == 0 else
+                                      [_key(pygame.K_q)] if i % 5 == 0 else [])
+        for tab, name in enumerate(("bag", "key_items", "monster")):
+            results[f"inventory_{name}"] = self.inventory(tab)
+        return results
+
+
+def compare(current: dict, baseline: dict, threshold: float = REGRESSION_THRESHOLD,
+            min_ms: float = REGRESSION_MIN_MS) -> list:
+    """
+    シーンごとに 1フレームの時間（最速回の平均）と frame の中央値を比べ、
+    threshold の割合以上かつ min_ms 以上遅くなった物を返す
+    """
+    regressions = []
+    for name, cur in current.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        pairs = [("ms_per_frame", cur["ms_per_frame"], base["ms_per_frame"])]
+        if "p50" in cur["phases"].get("frame", {}) and "p50" in base.get("phases", {}).get("frame", {}):
+            pairs.append(("frame_p50", cur["phases"]["frame"]["p50"], base["phases"]["frame"]["p50"]))
+        for metric, now, before in pairs:
+            if before > 0 and now > before * (1 + threshold) and now - before >= min_ms:
+                regressions.append({"scene": name, "metric": metric, "baseline": before,
+                                    "current": now, "ratio": now / before})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ヘッドレスのベンチマーク")
+    parser.add_argument("suite", nargs="?", choices=("all", "micro", "scenes"), default="all")
+    parser.add_argument("--frames", type=int, default=SCENE_FRAMES, help="シーンごとのフレーム数")
+    parser.add_argument("--repeat", type=int, default=SCENE_REPEAT, help="シーンごとに何回測って一番速い回を採るか")
+    parser.add_argument("--compare", metavar="PATH", help="以前の出力（JSON）と比べて退行を報告する")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--min-ms", type=float, default=REGRESSION_MIN_MS)
+    parser.add_argument("--renderer", choices=("software", "texture"), default="software",
+                        help="scenes を測る描画バックエンド")
+    parser.add_argument("--allow-soft-renderer", action="store_true",
+                        help="--renderer texture で GPU がなくても SDL のソフトウェア Renderer で測る")
+    args = parser.parse_args(argv)
+    if args.allow_soft_renderer:
+        poke.TEXTURE_REQUIRE_ACCELERATED = False
+
+    results = {}
+    if args.suite in ("all", "micro"):
+        results["micro"] = run_micro()
+    if args.suite in ("all", "scenes"):
+        bench = SceneBench(args.frames, args.repeat, args.renderer)
+        backend = bench.game.backend
+        # texture が使えず software に戻った時もわかるよう、実際に使ったバックエンドを残す
+        results["renderer"] = {"requested": args.renderer, "used": backend.name,
+                               "accelerated": backend.name == "texture" and poke.TEXTURE_REQUIRE_ACCELERATED}
+        results["scenes"] = bench.run()
+    regressions = []
+    if args.compare and "scenes" in results:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results["scenes"], baseline.get("scenes", {}), args.threshold, args.min_ms)
+        results["regressions"] = regressions
+        for r in regressions:
+            print(f"退行: {r['scene']} {r['metric']} {r['baseline']:.3f} -> {r['current']:.3f} ms"
+                  f"（x{r['ratio']:.2f}）", file=sys.stderr)
+    json.dump(results, sys.stdout, ensure_ascii=False, indent=2)
+    print()
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
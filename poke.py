@@ -5,6 +5,20 @@ import os
 import time
 import random
 import math
+import io
+import queue
+import threading
+import heapq
+import hashlib
+import json
+import struct
+import zlib
+import argparse
+import csv
+import atexit
+import weakref
+import numpy as np
+from collections import OrderedDict, deque
 from typing import Tuple, List
 
 """
@@ -29,53 +43,721 @@ MODE_TITLE  = 0
 MODE_SELECT = 1
 MODE_PLAY   = 2
 MODE_CLEAR  = 3
-# 上限（上方向の到達位置）設定
-USE_MANUAL_TOP_LIMIT = False  # True: MANUAL_TOP_Y を使う / False: 背景から自動検出
-MANUAL_TOP_Y = 150  # 手動で決める最小 top 座標（小さいほど上へ行ける）
-TOP_LIMIT_OFFSET = -300  # 自動検出値に加えるオフセット（負でさらに上へ行ける）
+# 歩行判定（背景の床色から歩けるマスを検出）
+USE_WALKABILITY = True  # True: 歩行グリッドで当たり判定 / False: 背景の範囲内ならどこでも歩ける
+WALK_TILE = 16  # 歩行グリッド1マスの大きさ（背景画像のピクセル）
+WALK_COLOR_TOL = 0.1  # 床色との色味（明るさを除いた色度）の距離がこれ未満なら床
+WALK_MIN_RATIO = 0.5  # マス内の床ピクセルの割合がこれ以上なら歩ける
+WALK_CLOSE_TILES = 2  # この幅（マス）以下の床の線や模様は歩けるものとして埋める
+CACHE_DIR = ".cache"  # 計算結果のキャッシュ置き場
 
 WINDOW_W, WINDOW_H = 800, 600
 
+# ワールド（座標は背景画像のピクセル。画面にはカメラに映る範囲だけ描く）
+MAP_CHUNK = 256  # マップを分割するチャンクの1辺（px）
+MAP_CHUNK_CACHE = 24  # メモリに置くチャンク数の上限（画面に映る最大 5x4 枚より多く）
+PLAYER_START = (461, 848)  # プレイヤーの初期位置（ワールド座標、左上）
+
+# フレーム間隔
+TARGET_FPS = 60  # 動きのある画面の上限フレームレート
+IDLE_WAIT_MS = 500  # 止まっている画面で入力を待つ最大時間（この間は描画しない）
+
+# 演出・移動の更新（描画のフレームレートに関係なく一定間隔で進め、描画はコマの間を補間する）
+SIM_HZ = 60  # 1秒あたりのコマ数（エフェクトの frames や ttl、歩く速さはこのコマ単位）
+SIM_MAX_STEPS = 5  # 1フレームで進める最大コマ数（それ以上遅れた分は捨てて固まらないようにする）
+EFFECT_TEXT_MS = 1000  # 「こうかは ばつぐんだ！」などを出しておく時間
+
+# 差分矩形描画（タイトル/セレクト/マップ/クリア画面のみ）
+# マップを歩いている間はカメラが動いて画面全体が変わるので、毎フレーム全画面になる（効くのはカメラが止まっている間と静止画面）
+USE_DIRTY_RECTS = False  # True: 変化した矩形だけ display.update する / False: 毎フレーム全画面 flip
+DIRTY_FULL_FLIP_RATIO = 0.4  # 差分の面積が画面のこの割合を超えたら全画面 flip に切り替える
+
+# 描画バックエンド（--renderer で切り替え）
+# "software": display のサーフェスに blit して flip / "texture": pygame._sdl2.video の Renderer とテクスチャで描く
+RENDER_BACKEND = "software"
+TEXTURE_REQUIRE_ACCELERATED = True  # True: GPU の Renderer が作れなければ software に戻す（False は SDL のソフトウェア Renderer も使う）
+TEXTURE_CACHE_SIZE = 128  # Surface から作ったテクスチャを取っておく数（チャンク・文字など。Surface は弱参照で持つ）
+
+# 計測（F3 でどの画面の上にもオーバーレイ表示）
+PROFILE_WINDOW = 300  # 直近何フレームぶんで p50/p95/p99 を出すか
+PROFILE_OVERLAY_KEY = pygame.K_F3
+PROFILE_OVERLAY_EVERY = 15  # オーバーレイの文字を作り直す間隔（フレーム）
+PROFILE_EXPORT = None  # "frames.csv" / "frames.jsonl" にすると1フレームごとの計測値を書き出す
+
+# 画質の自動調整（重いときはエフェクトを間引いて目標のフレーム時間を守る）
+# particles: パーティクル数の倍率 / smoke: かえんほうしゃの煙 / antialias: バトルの文字
+# passes: 線のエフェクトの重ね描き回数（2 で芯の明るい線も描く）
+QUALITY_TIERS = [
+    {"name": "high", "particles": 1.0, "smoke": True, "antialias": True, "passes": 2},
+    {"name": "medium", "particles": 0.6, "smoke": True, "antialias": True, "passes": 2},
+    {"name": "low", "particles": 0.35, "smoke": False, "antialias": True, "passes": 1},
+    {"name": "minimal", "particles": 0.15, "smoke": False, "antialias": False, "passes": 1},
+]
+QUALITY_BUDGET_MS = 1000 / TARGET_FPS  # 1フレームの処理時間の目標（入力待ちは除く）
+QUALITY_WINDOW = 60  # 判定に使う直近のフレーム数（段を変えたら貯め直す）
+QUALITY_DOWN_AT = 0.9  # 直近の p95 が目標のこの割合を超えたら1段下げる
+QUALITY_UP_AT = 0.5  # 直近の p95 がこの割合を下回ったら1段上げる（下げる側と離して行ったり来たりを防ぐ）
+QUALITY_UP_HOLD = 600  # 下げたあと、次に上げてみるまで待つフレーム数
+PRINT_QUALITY_CHANGES = True  # 段を変えるたびに標準エラーに表示する
+
 
 # ====== ユーティリティ ======
+# Windowsのメジャー日本語フォント候補（上から順に試す）
+JP_FONT_PATHS = [
+    "C:/Windows/Fonts/meiryo.ttc",
+    "C:/Windows/Fonts/msgothic.ttc",
+    "C:/Windows/Fonts/yugothb.ttf",
+    "C:/Windows/Fonts/yugothm.ttf",
+]
+TEXT_CACHE_SIZE = 256  # 描画済みテキストを保持する最大数（LRU）
+
+_UNRESOLVED = object()
+_jp_font_path = _UNRESOLVED
+_font_registry = {}  # (path, size) -> pygame.font.Font
+
+
+def get_font(path, size: int) -> pygame.font.Font:
+    """(path, size) ごとに Font を一度だけ生成して使い回す（path=None はデフォルトフォント）"""
+    key = (path, size)
+    font = _font_registry.get(key)
+    if font is None:
+        font = pygame.font.Font(path, size)
+        _font_registry[key] = font
+    return font
+
+
+def _resolve_jp_font_path():
+    """使える日本語フォントのパスを一度だけ探す。なければ None（デフォルト）"""
+    global _jp_font_path
+    if _jp_font_path is _UNRESOLVED:
+        _jp_font_path = None
+        for path in JP_FONT_PATHS:
+            if os.path.exists(path):
+                try:
+                    get_font(path, 12)
+                except Exception:
+                    continue
+                _jp_font_path = path
+                break
+    return _jp_font_path
+
+
 def get_jp_font(size: int) -> pygame.font.Font:
     # Windowsのメジャー日本語フォントを順に当てる。なければデフォルト。
-    font_paths = [
-        "C:/Windows/Fonts/meiryo.ttc",
-        "C:/Windows/Fonts/msgothic.ttc",
-        "C:/Windows/Fonts/yugothb.ttf",
-        "C:/Windows/Fonts/yugothm.ttf",
-    ]
-    for path in font_paths:
-        if os.path.exists(path):
-            try:
-                return pygame.font.Font(path, size)
-            except Exception:
-                pass
-    return pygame.font.Font(None, size)
+    return get_font(_resolve_jp_font_path(), size)
+
+
+class TextCache:
+    """描画済みテキストの LRU キャッシュ。キーは (text, size, color, antialias)"""
+    def __init__(self, maxsize: int = TEXT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._surfs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def render(self, text: str, size: int, color=(0, 0, 0), antialias: bool = True) -> pygame.Surface:
+        key = (text, size, tuple(color), antialias)
+        surf = self._surfs.get(key)
+        if surf is not None:
+            self.hits += 1
+            self._surfs.move_to_end(key)
+            return surf
+        self.misses += 1
+        surf = get_jp_font(size).render(text, antialias, color)
+        self._surfs[key] = surf
+        if len(self._surfs) > self.maxsize:
+            self._surfs.popitem(last=False)
+            self.evictions += 1
+        return surf
 
-def draw_text(surface, text, x, y, size=28, color=(0, 0, 0)):
-    font = get_jp_font(size)
-    surf = font.render(text, True, color)
-    surface.blit(surf, (x, y))
+    def clear(self):
+        self._surfs.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._surfs),
+            "maxsize": self.maxsize,
+            "hit_rate": self.hits / total if total else 0.0,
+            "fonts": len(_font_registry),
+        }
+
+
+TEXT_CACHE = TextCache()
+
+
+def render_text(text: str, size: int = 28, color=(0, 0, 0), antialias: bool = True) -> pygame.Surface:
+    """キャッシュ経由でテキストを描画する（戻り値は共有なので書き換えないこと）"""
+    return TEXT_CACHE.render(text, size, color, antialias)
+
+
+def draw_text(surface, text, x, y, size=28, color=(0, 0, 0), antialias=True):
+    surface.blit(render_text(text, size, color, antialias), (x, y))
 
 def scale_img(img: pygame.Surface, s: float) -> pygame.Surface:
     w, h = img.get_size()
     return pygame.transform.scale(img, (int(w * s), int(h * s)))
 
-def detect_top_walkable_y(bg_surf: pygame.Surface) -> int:
-    """背景から歩行可能上限を自動検出（中央帯の同色行を走査）"""
-    cx = bg_surf.get_rect().centerx
-    w, h = bg_surf.get_width(), bg_surf.get_height()
-    sample_y = int(h * 0.65)
-    floor_color = bg_surf.get_at((min(max(cx, 0), w - 1), min(max(sample_y, 0), h - 1)))
-    band = range(max(0, cx - 6), min(w, cx + 7))
-    for y in range(0, sample_y + 1):
-        if any(bg_surf.get_at((x, y)) == floor_color for x in band):
-            return y + 2
+# ====== アセット管理 ======
+class AssetManager:
+    """
+    画像ファイルを一度だけデコードし、目標サイズごとの表示形式版（convert/convert_alpha）を保持する
+    _raw・_cache・_prepared・load_times と回数は先読みスレッドからも触るので _lock の中で扱う（デコードと変換はロックの外）
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._raw = {}      # path -> デコード済み Surface（最初の表示形式版を作るまでの間だけ持つ）
+        self._cache = {}    # (path, size, alpha) -> 表示形式 Surface
+        self.load_times = {}  # path -> デコード時間（秒）
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0  # 縮小済みキャッシュ（ディスク）から読めた回数
+        self._prepared = {}  # (path, scale) -> 変換待ちの縮小済み Surface（先読みスレッドが置く）
+
+    def _decode(self, path: str) -> pygame.Surface:
+        t0 = time.perf_counter()
+        img = pygame.image.load(path)
+        with self._lock:
+            self.load_times[path] = time.perf_counter() - t0
+        return img
+
+    def load(self, path: str) -> pygame.Surface:
+        """ファイルをデコード（2回目以降はディスクを読まない）"""
+        with self._lock:
+            img = self._raw.get(path)
+        if img is None:
+            img = self._decode(path)
+            with self._lock:
+                img = self._raw.setdefault(path, img)  # 両方のスレッドで読んだら先に置かれた方を使う
+        return img
+
+    def prepare_scaled(self, path: str, scale: float) -> pygame.Surface:
+        """get_scaled の変換前まで（ディスクキャッシュ読み込み or デコード＋縮小）。ワーカースレッドからも呼べる"""
+        cache_path = os.path.join(CACHE_DIR, "assets", f"{_file_hash(path)}_{scale}.png")
+        img = None
+        if os.path.exists(cache_path):
+            try:
+                img = self._decode(cache_path)
+                with self._lock:
+                    self.disk_hits += 1
+            except pygame.error:
+                img = None
+        if img is None:
+            # 元画像は縮小したらすぐ手放す（_raw には残さない）
+            img = scale_img(self._decode(path), scale)
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                pygame.image.save(img, cache_path)
+            except (OSError, pygame.error):
+                pass
+        with self._lock:
+            self._prepared[(path, scale)] = img
+        return img
+
+    def get_scaled(self, path: str, scale: float, alpha: bool = True) -> pygame.Surface:
+        """元画像を scale 倍した表示形式版。縮小結果は (元画像のハッシュ, 倍率) で CACHE_DIR に保存し、
+        次回起動からは大きな元画像をデコードしない"""
+        key = (path, ("scale", scale), alpha)
+        surf = self._cached(key)
+        if surf is not None:
+            return surf
+        with self._lock:
+            img = self._prepared.pop((path, scale), None)
+        if img is None:
+            img = self.prepare_scaled(path, scale)
+            with self._lock:
+                self._prepared.pop((path, scale), None)
+        return self._store(key, img.convert_alpha() if alpha else img.convert())
+
+    def get(self, path: str, size=None, alpha: bool = True) -> pygame.Surface:
+        """size=(w, h) にスケールした表示形式版を返す（size=None は元サイズ）"""
+        key = (path, tuple(size) if size else None, alpha)
+        surf = self._cached(key)
+        if surf is not None:
+            return surf
+        img = self._source(path)
+        if size and img.get_size() != tuple(size):
+            img = pygame.transform.scale(img, size)
+        return self._store(key, img.convert_alpha() if alpha else img.convert())
+
+    def _cached(self, key):
+        with self._lock:
+            surf = self._cache.get(key)
+            if surf is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return surf
+
+    def _store(self, key, surf: pygame.Surface) -> pygame.Surface:
+        with self._lock:
+            return self._cache.setdefault(key, surf)  # 先に置かれていたらそちらを使う
+
+    def _source(self, path: str) -> pygame.Surface:
+        """
+        get の変換元。デコード済みの元画像は表示形式版を作ったら手放す（大きな元画像を持ち続けない）
+        手放したあとは元サイズの表示形式版があればそれから作り、なければデコードし直す
+        """
+        with self._lock:
+            img = self._raw.pop(path, None)
+            if img is None:
+                img = self._cache.get((path, None, True)) or self._cache.get((path, None, False))
+        if img is None:
+            img = self._decode(path)
+        return img
+
+    def release(self, surf: pygame.Surface):
+        """表示形式版をキャッシュから外す（SpriteAtlas に詰めたあと、同じ絵を二重に持たないように）"""
+        with self._lock:
+            self._cache = {k: v for k, v in self._cache.items() if v is not surf}
+
+    def memory_bytes(self) -> int:
+        with self._lock:
+            surfs = list(self._raw.values()) + list(self._cache.values())
+        return sum(s.get_width() * s.get_height() * s.get_bytesize() for s in surfs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            raw = list(self._raw.values())
+            variants, hits, misses = len(self._cache), self.hits, self.misses
+            disk_hits, load_times = self.disk_hits, dict(self.load_times)
+        return {
+            "raw_files": len(raw),  # まだ表示形式版を作っていない（先読みしただけの）元画像
+            "raw_bytes": sum(s.get_width() * s.get_height() * s.get_bytesize() for s in raw),
+            "variants": variants,
+            "hits": hits,
+            "misses": misses,
+            "disk_hits": disk_hits,
+            "load_time": sum(load_times.values()),
+            "load_times": load_times,
+            "memory_bytes": self.memory_bytes(),
+        }
+
+
+ASSETS = AssetManager()
+
+
+# ====== スプライトアトラス ======
+ATLAS_PAGE_SIZE = 768  # アトラス1枚の一辺（px）。いまのスプライト一式が1枚に収まる大きさ。これより大きいスプライトはそのサイズのページを1枚使う
+ATLAS_PADDING = 1  # スプライトの間のすき間（px）
+# False: ページに詰めず、make() の Surface をそのまま名前で1枚ずつ持つ
+# （ソフトウェア描画では blit は速くならず、ページの空きのぶんメモリが増えるだけだったので既定は使わない）
+USE_SPRITE_ATLAS = False
+
+class SpriteAtlas:
+    """
+    縮小済みのスプライトを数枚の大きな表示形式の面（ページ）にスカイライン法（一番低い所から詰める）でまとめる
+    名前 -> (ページ番号, 範囲) の索引を持ち、sprite() はページの subsurface を返すので、
+    呼ぶ側はふつうの Surface として blit / get_rect / mask に使える（画素はページと共有）
+    """
+    def __init__(self, page_size: int = ATLAS_PAGE_SIZE, padding: int = ATLAS_PADDING, enabled: bool = None):
+        self.page_size = page_size
+        self.padding = padding
+        self.enabled = USE_SPRITE_ATLAS if enabled is None else enabled
+        self.pages: List[pygame.Surface] = []
+        self.skylines = []  # ページごとの詰めた上端の輪郭（左から [x, 高さ, 幅]）
+        self.index = {}  # name -> (ページ番号, Rect)
+        self._sprites = {}  # name -> subsurface（enabled=False なら make() の Surface そのもの）
+        self._revisions = {}  # id(ページ) -> 書き込んだ回数（テクスチャを作り直す目安）
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def sprite(self, name: str, make) -> pygame.Surface:
+        """name のスプライト。まだ詰めていなければ make() の Surface をページに写して登録する"""
+        sub = self._sprites.get(name)
+        if sub is None:
+            if self.enabled:
+                sub = self.add(name, make())
+            else:
+                sub = self._sprites[name] = make()
+        return sub
+
+    def add(self, name: str, surf: pygame.Surface) -> pygame.Surface:
+        w, h = surf.get_size()
+        page, rect = self._place(w, h)
+        self.pages[page].blit(surf, rect)
+        key = id(self.pages[page])
+        self._revisions[key] = self._revisions.get(key, 0) + 1
+        self.index[name] = (page, rect)
+        sub = self._sprites[name] = self.pages[page].subsurface(rect)
+        return sub
+
+    def _place(self, w: int, h: int) -> Tuple[int, pygame.Rect]:
+        if w > self.page_size or h > self.page_size:
+            self._new_page(w, h)
+            self.skylines[-1] = [[0, h, w]]  # 埋まっている
+            return len(self.pages) - 1, pygame.Rect(0, 0, w, h)
+        pw, ph = w + self.padding, h + self.padding
+        for page, skyline in enumerate(self.skylines):
+            pos = self._fit(skyline, pw, ph, *self.pages[page].get_size())
+            if pos is not None:
+                self._raise(skyline, pos[0], pos[1] + ph, pw)
+                return page, pygame.Rect(pos[0], pos[1], w, h)
+        self._new_page(self.page_size, self.page_size)
+        self._raise(self.skylines[-1], 0, ph, pw)
+        return len(self.pages) - 1, pygame.Rect(0, 0, w, h)
+
+    def _fit(self, skyline, w: int, h: int, page_w: int, page_h: int):
+        """スカイライン（左から [x, 高さ, 幅]）の上で、幅 w を置ける一番低い位置（同じ高さなら左）"""
+        # w, h はすき間込みなので、右端・下端ではすき間の分だけはみ出してよい
+        page_w += self.padding
+        page_h += self.padding
+        best = None
+        for i, (x, _, _) in enumerate(skyline):
+            if x + w > page_w:
+                break
+            # x から幅 w の範囲にかかる区間のうち一番高いところに載せる
+            top, j = 0, i
+            while j < len(skyline) and skyline[j][0] < x + w:
+                top = max(top, skyline[j][1])
+                j += 1
+            if top + h <= page_h and (best is None or top < best[1]):
+                best = (x, top)
+        return best
+
+    @staticmethod
+    def _raise(skyline, x: int, top: int, w: int):
+        """x から幅 w の区間の高さを top にする"""
+        out = []
+        for sx, sy, sw in skyline:
+            # 新しい区間と重ならない部分だけ残す
+            if sx < x:
+                out.append([sx, sy, min(sw, x - sx)])
+            if sx + sw > x + w:
+                start = max(sx, x + w)
+                out.append([start, sy, sx + sw - start])
+        out.append([x, top, w])
+        out.sort()
+        # 同じ高さで隣り合う区間はまとめる
+        merged = [out[0]]
+        for seg in out[1:]:
+            last = merged[-1]
+            if last[1] == seg[1] and last[0] + last[2] == seg[0]:
+                last[2] += seg[2]
+            else:
+                merged.append(seg)
+        skyline[:] = merged
+
+    def _new_page(self, w: int, h: int):
+        page = pygame.Surface((w, h), pygame.SRCALPHA).convert_alpha()
+        page.fill((0, 0, 0, 0))
+        self.pages.append(page)
+        self.skylines.append([[0, 0, w]])
+
+    def revision(self, page: pygame.Surface) -> int:
+        """page に書き込んだ回数（アトラスのページでなければ 0）"""
+        return self._revisions.get(id(page), 0)
+
+    def blit(self, dst: pygame.Surface, name: str, pos):
+        """ページから直接 name の範囲を blit する"""
+        page, rect = self.index[name]
+        return dst.blit(self.pages[page], pos, rect)
+
+    def memory_bytes(self) -> int:
+        # ページと、ページに詰めずに持っているスプライト
+        surfs = self.pages + [s for s in self._sprites.values() if s.get_parent() is None]
+        return sum(s.get_width() * s.get_height() * s.get_bytesize() for s in surfs)
+
+    def stats(self) -> dict:
+        used = sum(r.width * r.height for _, r in self.index.values())
+        total = sum(p.get_width() * p.get_height() for p in self.pages)
+        return {
+            "enabled": self.enabled,
+            "pages": len(self.pages),
+            "sprites": len(self._sprites),
+            "memory_bytes": self.memory_bytes(),
+            "fill_ratio": used / total if total else 0.0,
+        }
+
+
+ATLAS = SpriteAtlas()
+
+
+def atlas_scaled(path: str, scale: float) -> pygame.Surface:
+    """ASSETS.get_scaled の絵をアトラスに詰めたもの"""
+    def make():
+        surf = ASSETS.get_scaled(path, scale)
+        ASSETS.release(surf)
+        return surf
+    return ATLAS.sprite(f"{path}@{scale}", make)
+
+
+def atlas_sized(path: str, size) -> pygame.Surface:
+    """ASSETS.get(path, size) の絵をアトラスに詰めたもの"""
+    def make():
+        surf = ASSETS.get(path, size)
+        ASSETS.release(surf)
+        return surf
+    return ATLAS.sprite(f"{path}@{size[0]}x{size[1]}", make)
+
+# ====== 歩行グリッド ======
+def _file_hash(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def _morph(mask: np.ndarray, r: int, op) -> np.ndarray:
+    """半径 r の正方形で膨張（op=logical_or）／収縮（op=logical_and）"""
+    p = np.pad(mask, r, constant_values=False)
+    out = mask.copy()
+    w, h = mask.shape
+    for dx in range(2 * r + 1):
+        for dy in range(2 * r + 1):
+            out = op(out, p[dx:dx + w, dy:dy + h])
+    return out
+
+def compute_walkable_grid(bg_surf: pygame.Surface, tile: int = WALK_TILE) -> np.ndarray:
+    """背景から歩けるマスの bool グリッド（[x, y] 添字）を作る。床色は画像で一番多い色"""
+    rgb = pygame.surfarray.array3d(bg_surf).astype(np.int32)
+    # 16段階に量子化して最頻色を床色とする
+    q = (rgb // 16).reshape(-1, 3)
+    keys = q[:, 0] * 256 + q[:, 1] * 16 + q[:, 2]
+    mode = np.bincount(keys).argmax()
+    floor = np.array([mode // 256, (mode // 16) % 16, mode % 16], np.float32) * 16 + 8
+    # 明るさの影響を除くため色度（r, g, b の比率）で比べる
+    chroma = rgb / (rgb.sum(axis=2, keepdims=True) + 1.0)
+    ref = floor / floor.sum()
+    is_floor = ((chroma - ref) ** 2).sum(axis=2) < WALK_COLOR_TOL ** 2
+    w, h = is_floor.shape
+    gw, gh = w // tile, h // tile
+    ratio = is_floor[:gw * tile, :gh * tile].reshape(gw, tile, gh, tile).mean(axis=(1, 3))
+    grid = ratio >= WALK_MIN_RATIO
+    if WALK_CLOSE_TILES:
+        grid = _morph(_morph(grid, WALK_CLOSE_TILES, np.logical_or), WALK_CLOSE_TILES, np.logical_and)
+    return grid
+
+
+class WalkabilityMap:
+    """歩けるマスのグリッド。ワールド座標（背景画像のピクセル）の矩形がすべて歩けるマスに乗っているかを調べる"""
+    def __init__(self, grid: np.ndarray, tile: int):
+        self.grid = grid
+        self.tile = tile
+
+    @classmethod
+    def load(cls, path: str, tile: int = WALK_TILE):
+        """画像の内容ハッシュをキーにディスクキャッシュを使う（無ければ画像をデコードして計算し、保存）"""
+        params = f"{tile}_{WALK_COLOR_TOL}_{WALK_MIN_RATIO}_{WALK_CLOSE_TILES}"
+        cache_path = os.path.join(CACHE_DIR, f"walk_{_file_hash(path)}_{params}.npy")
+        grid = None
+        if os.path.exists(cache_path):
+            try:
+                grid = np.load(cache_path)
+            except (OSError, ValueError):
+                grid = None
+        if grid is None:
+            grid = compute_walkable_grid(pygame.image.load(path), tile)
+            try:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                np.save(cache_path, grid)
+            except OSError:
+                pass
+        return cls(grid, tile)
+
+    def is_walkable_rect(self, rect: pygame.Rect) -> bool:
+        """rect（ワールド座標）が重なるマスがすべて歩けるか。グリッド外は歩けない"""
+        gw, gh = self.grid.shape
+        x0, x1 = rect.left // self.tile, (rect.right - 1) // self.tile
+        y0, y1 = rect.top // self.tile, (rect.bottom - 1) // self.tile
+        if x0 < 0 or y0 < 0 or x1 >= gw or y1 >= gh:
+            return False
+        return bool(self.grid[x0:x1 + 1, y0:y1 + 1].all())
+
+
+# ====== ワールド（カメラとチャンク分割マップ） ======
+class Camera:
+    """ワールド座標のうち画面に映す範囲（rect）。follow で対象を真ん中に置き、ワールドの外はなるべく映さない"""
+    def __init__(self, view_size, world_rect: pygame.Rect):
+        self.rect = pygame.Rect((0, 0), view_size)
+        self.world_rect = world_rect
+
+    def follow(self, target: pygame.Rect):
+        self.rect.center = target.center
+        self.rect.clamp_ip(self.world_rect)
+
+    def to_screen(self, rect: pygame.Rect) -> pygame.Rect:
+        return rect.move(-self.rect.x, -self.rect.y)
+
+    def to_world(self, pos) -> Tuple[int, int]:
+        return pos[0] + self.rect.x, pos[1] + self.rect.y
+
+
+class ChunkedMap:
+    """
+    マップ画像を chunk 四方のチャンク画像に分けてディスク（CACHE_DIR/chunks）に置き、
+    カメラに映るチャンクだけを読み込む。読み込んだチャンクは LRU で capacity 枚まで持つ
+    （チャンクは無圧縮の BMP。PNG より書き出し・読み込みが数十倍速く、スクロール中に引っかからない）
+    （capacity は画面に同時に映る枚数より多くしておくこと）
+    """
+    def __init__(self, chunk_dir: str, world_size, chunk: int = MAP_CHUNK,
+                 capacity: int = MAP_CHUNK_CACHE, pinned: dict = None):
+        self.chunk_dir = chunk_dir
+        self.world_rect = pygame.Rect((0, 0), world_size)
+        self.chunk = chunk
+        self.capacity = capacity
+        self._pinned = pinned or {}  # ディスクに書けなかった時のチャンク（常駐）
+        self._resident = OrderedDict()  # (cx, cy) -> Surface
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+
+    @classmethod
+    def open(cls, path: str, chunk: int = MAP_CHUNK, capacity: int = MAP_CHUNK_CACHE) -> "ChunkedMap":
+        """画像の内容ハッシュごとにチャンクを用意する（用意済みなら元画像はデコードしない）"""
+        chunk_dir = os.path.join(CACHE_DIR, "chunks", f"{_file_hash(path)}_{chunk}")
+        try:
+            with open(os.path.join(chunk_dir, "index.json"), encoding="utf-8") as f:
+                return cls(chunk_dir, tuple(json.load(f)["size"]), chunk, capacity)
+        except (OSError, ValueError, KeyError):
+            pass
+        surf = pygame.image.load(path)
+        w, h = surf.get_size()
+        pieces = {}
+        for cy in range(0, h, chunk):
+            for cx in range(0, w, chunk):
+                rect = pygame.Rect(cx, cy, chunk, chunk).clip(surf.get_rect())
+                pieces[(cx // chunk, cy // chunk)] = surf.subsurface(rect).copy()
+        try:
+            os.makedirs(chunk_dir, exist_ok=True)
+            for (cx, cy), piece in pieces.items():
+                pygame.image.save(piece, os.path.join(chunk_dir, f"{cx}_{cy}.bmp"))
+            # 目次は最後に書く（途中で止まったら次回やり直す）
+            with open(os.path.join(chunk_dir, "index.json"), "w", encoding="utf-8") as f:
+                json.dump({"size": [w, h], "chunk": chunk}, f)
+        except (OSError, pygame.error):
+            return cls(chunk_dir, (w, h), chunk, capacity, pinned=pieces)
+        return cls(chunk_dir, (w, h), chunk, capacity)
+
+    def get(self, cx: int, cy: int) -> pygame.Surface:
+        key = (cx, cy)
+        surf = self._resident.get(key)
+        if surf is not None:
+            self._resident.move_to_end(key)
+            self.hits += 1
+            return surf
+        surf = self._pinned.get(key)
+        if surf is None:
+            surf = pygame.image.load(os.path.join(self.chunk_dir, f"{cx}_{cy}.bmp"))
+        surf = surf.convert()
+        self.loads += 1
+        self._resident[key] = surf
+        while len(self._resident) > self.capacity:
+            self._resident.popitem(last=False)
+            self.evictions += 1
+        return surf
+
+    def visible(self, view: pygame.Rect) -> List[Tuple[int, int]]:
+        """view（ワールド座標）に重なるチャンクの番号"""
+        r = view.clip(self.world_rect)
+        if not r.width or not r.height:
+            return []
+        c = self.chunk
+        return [(cx, cy)
+                for cy in range(r.top // c, (r.bottom - 1) // c + 1)
+                for cx in range(r.left // c, (r.right - 1) // c + 1)]
+
+    def draw(self, surf: pygame.Surface, camera: Camera, area: pygame.Rect = None):
+        """area（画面座標）を渡すとそこに映るチャンクだけを描く（area の外へのはみ出しは呼び出し側のクリップで切る）"""
+        view = camera.rect if area is None else area.move(camera.rect.topleft)
+        if not self.world_rect.contains(view):
+            surf.fill((0, 0, 0))  # ワールドの外
+        c = self.chunk
+        surf.blits([(self.get(cx, cy), (cx * c - camera.rect.x, cy * c - camera.rect.y))
+                    for cx, cy in self.visible(view)], False)
+
+    def stats(self) -> dict:
+        return {
+            "resident": len(self._resident),
+            "resident_bytes": sum(s.get_bytesize() * s.get_width() * s.get_height()
+                                  for s in self._resident.values()),
+            "loads": self.loads,
+            "hits": self.hits,
+            "evictions": self.evictions,
+        }
+
+# ====== 起動時の先読み ======
+PRINT_STARTUP_TIMELINE = False  # True: 先読みが終わったらアセットごとのデコード時間を標準エラーに表示する
+
+class AssetPreloader:
+    """画像・音声のデコードをワーカースレッドで行い、表示形式への変換（convert）はメインスレッドで行う。
+    メインループは pump() で届いた物から順に仕上げ、require() で必要な物だけ待つ
+    画像は finish で ASSETS（やアトラス）に置くだけで ready には残さない（使う側は ASSETS から取る）"""
+    def __init__(self):
+        self._jobs = []  # (name, work, finish)  work はワーカー側、finish はメインスレッド側
+        self._finish = {}
+        self._queue = queue.Queue()
+        self._thread = None
+        self.ready = {}  # name -> finish の戻り値（画像の job は None。完了の印）
+        self.timeline = []  # (name, デコード秒, 変換秒, 起動からの完了時刻)
+        self._t0 = time.perf_counter()
+
+    def add(self, name: str, work, finish=None):
+        self._jobs.append((name, work))
+        self._finish[name] = finish
+
+    def add_image(self, path: str, alpha: bool = True, size=None, make=None):
+        """デコードはワーカー、変換は finish で ASSETS.get(path, size, alpha)（make を渡せば make() で作る）"""
+        def finish(_):
+            if make is None:
+                ASSETS.get(path, size, alpha)
+            else:
+                make()
+        self.add(path, lambda: ASSETS.load(path), finish)
+
+    def add_scaled(self, path: str, scale: float):
+        def finish(_):
+            ASSETS.get_scaled(path, scale)
+        self.add(path, lambda: ASSETS.prepare_scaled(path, scale), finish)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._work, name="asset-preloader", daemon=True)
+        self._thread.start()
+
+    def _work(self):
+        for name, work in self._jobs:
+            t0 = time.perf_counter()
+            try:
+                value, error = work(), None
+            except Exception as e:  # メインスレッドで投げ直す
+                value, error = None, e
+            self._queue.put((name, value, error, time.perf_counter() - t0))
+
+    def pump(self, block: bool = False):
+        """届いているアセットを仕上げる（block=True なら最低1つ届くまで待つ）"""
+        while True:
+            try:
+                name, value, error, decode_sec = self._queue.get(block)
+            except queue.Empty:
+                return
+            block = False
+            if error is not None:
+                raise error
+            t0 = time.perf_counter()
+            finish = self._finish[name]
+            self.ready[name] = finish(value) if finish else value
+            done = time.perf_counter()
+            self.timeline.append((name, decode_sec, done - t0, done - self._t0))
+            if self.done() and PRINT_STARTUP_TIMELINE:
+                print(self.format_timeline(), file=sys.stderr)
+
+    def require(self, *names):
+        """指定のアセットが揃うまで待ち、ready の値を並べて返す（先読みに登録していない名前は待たずに None）"""
+        while any(n in self._finish and n not in self.ready for n in names):
+            self.pump(block=True)
+        return [self.ready.get(n) for n in names]
+
+    def done(self) -> bool:
+        return len(self.ready) == len(self._jobs)
+
+    def format_timeline(self) -> str:
+        lines = ["[startup] asset               decode(ms)  convert(ms)  ready_at(ms)"]
+        for name, dec, conv, at in self.timeline:
+            lines.append(f"[startup] {name:<20} {dec * 1000:10.1f} {conv * 1000:12.1f} {at * 1000:13.1f}")
+        return "\n".join(lines)
 
-    # 見つからなければ 0 付近を返す（安全側）
-    return 2
 
 def _lerp(a, b, t):
     return a + (b - a) * t
@@ -88,47 +770,148 @@ def _dir(a, b):
 
 
 # ====== ダメージ浮遊テキスト ======
+FLOAT_TEXT_SIZE = 36
+FLOAT_TEXT_COLOR = (255, 255, 0)
+FLOAT_FADE_TTL = 20  # 残りコマ数がこれを切ったら薄くしていく
+FLOAT_ALPHA_LEVELS = 8  # フェードのアルファの段数（任意の値ではなくこの段に丸めて、段ごとの絵を使い回す）
+FLOAT_NUMBER_CACHE = 1024  # 組み立て済みの (数字の列, アルファの段) を取っておく数（2桁すべて×8段が収まる。1枚 26x24 ほどで合計 2.5MB 程度）
+
+class GlyphAtlas:
+    """
+    ダメージ表示に使う文字（数字）を1枚の横長の面に一度だけ描いておき、数字の列はそこから切り出して組み立てる
+    組み立てた列はアルファの段ごとに LRU で取っておくので、同じダメージ値なら毎フレーム1回の blit で済む
+    """
+    def __init__(self, chars: str = "0123456789", size: int = FLOAT_TEXT_SIZE, color=FLOAT_TEXT_COLOR,
+                 antialias: bool = True, levels: int = FLOAT_ALPHA_LEVELS):
+        font = get_jp_font(size)
+        glyphs = [font.render(c, antialias, color) for c in chars]
+        self.height = max(g.get_height() for g in glyphs)
+        strip = pygame.Surface((sum(g.get_width() for g in glyphs), self.height), pygame.SRCALPHA)
+        self.rects = {}  # 文字 -> strip 上の範囲
+        x = 0
+        for c, g in zip(chars, glyphs):
+            strip.blit(g, (x, 0))
+            self.rects[c] = pygame.Rect(x, 0, g.get_width(), self.height)
+            x += g.get_width()
+        self.strip = strip.convert_alpha()
+        self.alphas = [255 * (i + 1) // levels for i in range(levels)]  # 段 -> アルファ（最後が不透明）
+        self._levels = [min(levels - 1, max(0, -(-a * levels // 255) - 1)) for a in range(256)]  # アルファ -> 段
+        self._numbers = OrderedDict()  # (text, 段) -> Surface
+
+    def covers(self, text: str) -> bool:
+        return all(c in self.rects for c in text)
+
+    def width(self, text: str) -> int:
+        return sum(self.rects[c].width for c in text)
+
+    def level(self, alpha: int) -> int:
+        """alpha 以上で一番近い段"""
+        return self._levels[min(255, max(0, alpha))]
+
+    def render(self, text: str, alpha: int = 255) -> pygame.Surface:
+        """text を並べた面（アルファは段に丸める。戻り値は共有なので書き換えないこと）"""
+        key = (text, self.level(alpha))
+        surf = self._numbers.get(key)
+        if surf is not None:
+            self._numbers.move_to_end(key)
+            return surf
+        surf = pygame.Surface((self.width(text), self.height), pygame.SRCALPHA).convert_alpha()
+        x = 0
+        for c in text:
+            area = self.rects[c]
+            surf.blit(self.strip, (x, 0), area)
+            x += area.width
+        if key[1] < len(self.alphas) - 1:
+            # 面のアルファは重ねず、画素ごとのアルファに掛け込んでおく（blit は不透明の段と同じ1回の合成で済む）
+            surf.fill((255, 255, 255, self.alphas[key[1]]), special_flags=pygame.BLEND_RGBA_MULT)
+        self._numbers[key] = surf
+        if len(self._numbers) > FLOAT_NUMBER_CACHE:
+            self._numbers.popitem(last=False)
+        return surf
+
+
+_glyph_atlases = {}  # antialias -> GlyphAtlas
+
+def get_glyph_atlas(antialias: bool = True) -> GlyphAtlas:
+    """ダメージ表示の数字のアトラス（最初に使うときに作る。表示の初期化より後に呼ぶこと）"""
+    atlas = _glyph_atlases.get(antialias)
+    if atlas is None:
+        atlas = _glyph_atlases[antialias] = GlyphAtlas(antialias=antialias)
+    return atlas
+
+
 class FloatingNumber:
-    def __init__(self, text: str, pos: Tuple[int, int], vy: float = -1.0, ttl: int = 60):
+    """上に流れて消えるダメージ表示（update は1コマ、ttl はコマ数）"""
+    def __init__(self, text: str, pos: Tuple[int, int], vy: float = -1.0, ttl: int = 60, antialias: bool = True):
         self.text = text
+        self.antialias = antialias
         self.x, self.y = pos
+        self.prev_y = self.y
         self.vy = vy
         self.ttl = ttl
         self.alpha = 255
+        self.surf = None  # アトラスにない文字を含むときだけ作る（set_alpha するのでキャッシュの複製を持つ）
+        self._atlas = None  # 初回描画で決める（文字がすべてアトラスにあればそのアトラス、なければ False）
+        self._face = (None, None)  # (描いたアルファ, アトラスの面)。アルファが変わらない間は引き直さない
 
     def update(self) -> bool:
+        self.prev_y = self.y
         self.y += self.vy
         self.ttl -= 1
-        if self.ttl < 20:
-            self.alpha = int(255 * (self.ttl / 20))
+        if self.ttl < FLOAT_FADE_TTL:
+            self.alpha = int(255 * (self.ttl / FLOAT_FADE_TTL))
         return self.ttl > 0
 
-    def draw(self, screen):
-        font = get_jp_font(36)
-        surf = font.render(self.text, True, (255, 255, 0))
-        surf.set_alpha(self.alpha)
-        screen.blit(surf, (self.x, self.y))
+    def draw(self, screen, alpha: float = 1.0):
+        pos = (self.x, _lerp(self.prev_y, self.y, alpha))
+        if self._atlas is None:
+            atlas = get_glyph_atlas(self.antialias)
+            self._atlas = atlas if atlas.covers(self.text) else False
+        if self._atlas:
+            if self.alpha > 0:
+                drawn, surf = self._face
+                if drawn != self.alpha:
+                    surf = self._atlas.render(self.text, self.alpha)
+                    self._face = (self.alpha, surf)
+                screen.blit(surf, pos)
+            return
+        if self.surf is None:
+            self.surf = render_text(self.text, FLOAT_TEXT_SIZE, FLOAT_TEXT_COLOR, self.antialias).copy()
+        self.surf.set_alpha(self.alpha)
+        screen.blit(self.surf, pos)
 
 
 # ====== プレイヤー ======
 class Player:
-    def __init__(self, bg_rect: pygame.Rect):
-        self.down_img = pygame.image.load("player_down.png").convert_alpha()
-        self.left_img = pygame.image.load("player_side_left.png").convert_alpha()
-        self.right_img = pygame.transform.flip(self.left_img, True, False)
-
+    def __init__(self, world_rect: pygame.Rect):
         player_scale = 0.1
-        pw, ph = self.down_img.get_size()
-        new_size = (int(pw * player_scale), int(ph * player_scale))
-        self.down_img  = pygame.transform.scale(self.down_img, new_size)
-        self.left_img  = pygame.transform.scale(self.left_img, new_size)
-        self.right_img = pygame.transform.scale(self.right_img, new_size)
+        self.down_img = atlas_scaled("player_down.png", player_scale)
+        self.left_img = atlas_scaled("player_side_left.png", player_scale)
+        self.right_img = ATLAS.sprite(f"player_side_right.png@{player_scale}",
+                                      lambda: pygame.transform.flip(self.left_img, True, False))
 
         self.image = self.down_img
-        self.rect = self.image.get_rect(topleft=(465, 600))
-        self.bg_rect = bg_rect
-
-    def update(self, keys, top_limit: int):
+        self.rect = self.image.get_rect(topleft=PLAYER_START)
+        self.prev_topleft = self.rect.topleft  # 1コマ前の位置（描画の補間用）
+        self.alpha = 1.0  # 描画する位置（1コマ前→今）の割合
+        self.world_rect = world_rect
+
+    def place(self, pos):
+        """瞬間移動（補間しない）"""
+        self.rect.topleft = self.prev_topleft = pos
+
+    def render_rect(self) -> pygame.Rect:
+        (px, py), (x, y) = self.prev_topleft, self.rect.topleft
+        return self.rect.move(round(_lerp(px, x, self.alpha)) - x, round(_lerp(py, y, self.alpha)) - y)
+
+    def feet_rect(self) -> pygame.Rect:
+        """足元（当たり判定に使う下端の帯）"""
+        w, h = self.rect.size
+        return pygame.Rect(self.rect.centerx - w // 4, self.rect.bottom - h // 5, w // 2, h // 5)
+
+    def update(self, keys, walk_map: "WalkabilityMap" = None):
+        """1コマ分動く"""
+        self.prev_topleft = self.rect.topleft
         dx = dy = 0
         speed = 4
         if keys[pygame.K_LEFT]:
@@ -144,25 +927,26 @@ class Player:
             dy = speed
             self.image = self.down_img
 
+        old_rect = self.rect.copy()
+        was_walkable = walk_map is not None and walk_map.is_walkable_rect(self.feet_rect())
         self.rect.x += dx
         self.rect.y += dy
-        self.rect.clamp_ip(self.bg_rect)
-        if self.rect.top < top_limit:
-            self.rect.top = top_limit
+        self.rect.clamp_ip(self.world_rect)
+        # 歩けないマスには入れない（最初から歩けない所にいる時は閉じ込めないよう動ける）
+        if was_walkable and not walk_map.is_walkable_rect(self.feet_rect()):
+            self.rect = old_rect
 
-    def draw(self, screen: pygame.Surface):
-        screen.blit(self.image, self.rect)
+    def draw(self, screen: pygame.Surface, camera: "Camera" = None):
+        rect = self.render_rect()
+        screen.blit(self.image, camera.to_screen(rect) if camera else rect)
 
 
 # ====== タマゴ ======
 class Egg:
-    def __init__(self, bg_rect: pygame.Rect):
-        egg_img = pygame.image.load("egg.png").convert_alpha()
+    def __init__(self, area: pygame.Rect):
         egg_scale = 0.35
-        ew, eh = egg_img.get_size()
-        egg_img = pygame.transform.scale(egg_img, (int(ew * egg_scale), int(eh * egg_scale)))
-        self.image = egg_img
-        self.rect = self.image.get_rect(center=bg_rect.center)
+        self.image = atlas_scaled("egg.png", egg_scale)
+        self.rect = self.image.get_rect(center=area.center)
 
     def draw(self, screen: pygame.Surface):
         screen.blit(self.image, self.rect)
@@ -171,9 +955,7 @@ class Egg:
 # ====== 相棒（セレクト/クリア演出用） ======
 class Partner:
     def __init__(self, name: str):
-        img = pygame.image.load("3.png").convert_alpha()
-        img = scale_img(img, 5)
-        self.image = img
+        self.image = ATLAS.sprite("3.png@5", lambda: scale_img(ASSETS.get("3.png"), 5))
         self.name = name
 
     def draw_center(self, screen: pygame.Surface, center_pos):
@@ -186,115 +968,1294 @@ class Partner:
         screen.blit(self.image, rect)
 
 
+# ====== 空間ハッシュ（マップ上のエンティティ） ======
+SPATIAL_CELL = 64  # 1セルの大きさ（px）。エンティティ1体ぶんくらいが目安
+
+class SpatialHash:
+    """
+    一様グリッドで .rect を持つエンティティを索引する
+    セルにはエンティティの id を入れ、当たり判定は常に今の entity.rect で行う
+    （同じセルの範囲内で動くだけなら move() は何もしない）
+    """
+    def __init__(self, cell: int = SPATIAL_CELL):
+        self.cell = cell
+        self.cells = {}    # (cx, cy) -> set(id)
+        self.entries = {}  # id -> (entity, セル範囲, 登録順)
+        self._seq = 0
+
+    def _span(self, rect: pygame.Rect) -> Tuple[int, int, int, int]:
+        c = self.cell
+        return (rect.left // c, rect.top // c,
+                max(rect.left, rect.right - 1) // c, max(rect.top, rect.bottom - 1) // c)
+
+    def _cells(self, span):
+        x0, y0, x1, y1 = span
+        for cy in range(y0, y1 + 1):
+            for cx in range(x0, x1 + 1):
+                yield cx, cy
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, entity) -> bool:
+        return id(entity) in self.entries
+
+    def insert(self, entity):
+        if id(entity) in self.entries:
+            self.move(entity)
+            return
+        span = self._span(entity.rect)
+        self.entries[id(entity)] = (entity, span, self._seq)
+        self._seq += 1
+        for key in self._cells(span):
+            self.cells.setdefault(key, set()).add(id(entity))
+
+    def remove(self, entity):
+        entry = self.entries.pop(id(entity), None)
+        if entry is None:
+            return
+        for key in self._cells(entry[1]):
+            bucket = self.cells[key]
+            bucket.discard(id(entity))
+            if not bucket:
+                del self.cells[key]
+
+    def move(self, entity):
+        """entity.rect を動かした後に呼ぶ（セルが変わった時だけ付け替える）"""
+        entry = self.entries.get(id(entity))
+        if entry is None:
+            return
+        span = self._span(entity.rect)
+        if span == entry[1]:
+            return
+        self.remove(entity)
+        self.entries[id(entity)] = (entity, span, entry[2])
+        for key in self._cells(span):
+            self.cells.setdefault(key, set()).add(id(entity))
+
+    def query(self, rect: pygame.Rect, mask: pygame.mask.Mask = None) -> list:
+        """
+        rect と重なるエンティティを登録順で返す
+        mask を渡すと、rect の位置に置いた mask とエンティティの .mask がピクセル単位で重なるものだけ返す
+        """
+        ids = set()
+        for key in self._cells(self._span(rect)):
+            bucket = self.cells.get(key)
+            if bucket:
+                ids |= bucket
+        hits = []
+        for i in ids:
+            entity, _, seq = self.entries[i]
+            other = entity.rect
+            if not rect.colliderect(other):
+                continue
+            if mask is not None and not mask.overlap(entity.mask, (other.x - rect.x, other.y - rect.y)):
+                continue
+            hits.append((seq, entity))
+        hits.sort(key=lambda h: h[0])
+        return [entity for _, entity in hits]
+
+
 # ====== ボス ======
 class Boss:
     def __init__(self, name: str, img_path: str, type_: str, scale: float, x: int, y: int):
         self.name = name
         self.type = type_
-        img = pygame.image.load(img_path).convert_alpha()
-        self.image = scale_img(img, scale)
+        self.type_id = TYPE_CHART.id(type_)
+        self.image = atlas_scaled(img_path, scale)
         self.rect = self.image.get_rect(topleft=(x, y))
-        self.alive = True
+        self.grid = None  # BossGroup が SpatialHash を入れる
+        self._mask = None
+        self._alive = True
+
+    @property
+    def alive(self) -> bool:
+        return self._alive
+
+    @alive.setter
+    def alive(self, value: bool):
+        # 倒されたら索引から外し、生き返ったら戻す
+        if value == self._alive:
+            return
+        self._alive = value
+        if self.grid is not None:
+            if value:
+                self.grid.insert(self)
+            else:
+                self.grid.remove(self)
 
-    def draw(self, screen: pygame.Surface):
+    @property
+    def mask(self) -> pygame.mask.Mask:
+        if self._mask is None:
+            self._mask = pygame.mask.from_surface(self.image)
+        return self._mask
+
+    def move_to(self, x: int, y: int):
+        self.rect.topleft = (x, y)
+        if self.grid is not None:
+            self.grid.move(self)
+
+    def draw(self, screen: pygame.Surface, camera: Camera = None):
         if self.alive:
-            screen.blit(self.image, self.rect)
+            screen.blit(self.image, camera.to_screen(self.rect) if camera else self.rect)
+
+# ボス：名前, 画像, タイプ, 縮小率, x, y（ワールド座標。シミュレーション用にデータとして持つ）
+BOSS_SPECS = [
+    ("イエローボス", "boss_yellow.png", "でんき", 0.2, 256, 341),
+    ("レッドボス",   "boss_red.png",    "ほのお", 0.2, 512, 341),
+    ("ブルーボス",   "boss_white.png",  "みず",   0.18, 768, 307),
+]
 
 class BossGroup:
     def __init__(self):
-        self.bosses: List[Boss] = [
-            Boss("イエローボス", "boss_yellow.png", "でんき", 0.2, 200, 200),
-            Boss("レッドボス",   "boss_red.png",    "ほのお", 0.2, 400, 200),
-            Boss("ブルーボス",   "boss_white.png",  "みず",   0.18, 600, 180),
+        self.bosses: List[Boss] = [Boss(*spec) for spec in BOSS_SPECS]
+        # 生きているボスだけを空間ハッシュに入れておく
+        self.grid = SpatialHash()
+        for b in self.bosses:
+            b.grid = self.grid
+            if b.alive:
+                self.grid.insert(b)
+
+    def visible(self, camera: Camera) -> List[Boss]:
+        """カメラに映る生きたボス"""
+        return self.grid.query(camera.rect)
+
+    def draw(self, screen: pygame.Surface, camera: Camera = None):
+        for b in (self.visible(camera) if camera else self.bosses):
+            b.draw(screen, camera)
+
+    def alive_collision_with(self, rect: pygame.Rect, mask: pygame.mask.Mask = None):
+        """rect（mask を渡せばピクセル単位）で重なる生きたボスのうち最初の1体"""
+        hits = self.grid.query(rect, mask)
+        return hits[0] if hits else None
+
+    def any_alive(self) -> bool:
+        return len(self.grid) > 0
+
+
+# ====== マップ描画（静的レイヤーのキャッシュ） ======
+MAP_HINT_TEXT = "F: ペットモード / ボスに触れるとバトル"
+
+class MapRenderer:
+    """
+    カメラに映るチャンクとボスを1枚のレイヤーに合成してキャッシュする
+    カメラが動いたらレイヤーをスクロールして、新しく映った端の帯だけを描き足す（作り直すのはボスや画面サイズが変わった時だけ）
+    HUD は画面に固定なのでレイヤーには入れず、毎フレーム上に重ねる
+    """
+    def __init__(self, world_map: ChunkedMap):
+        self.world_map = world_map
+        self._layer = None
+        self._layer_key = None
+        self._origin = None  # レイヤーを描いた時のカメラ位置（ワールド座標）
+        self.rebuilds = 0
+        self.scrolls = 0
+
+    def _paint(self, layer: pygame.Surface, camera: Camera, bosses: BossGroup, area: pygame.Rect):
+        """レイヤーの area（画面座標）だけをチャンクとボスで描き直す"""
+        layer.set_clip(area)
+        self.world_map.draw(layer, camera, area)
+        view = area.move(camera.rect.topleft)
+        for b in bosses.grid.query(view):
+            b.draw(layer, camera)
+        layer.set_clip(None)
+
+    def static_layer(self, size, camera: Camera, bosses: BossGroup) -> pygame.Surface:
+        key = (size, tuple((id(b), b.rect.topleft) for b in bosses.bosses if b.alive))
+        origin = camera.rect.topleft
+        if self._layer is None or key != self._layer_key:
+            if self._layer is None or self._layer.get_size() != size:
+                self._layer = pygame.Surface(size).convert()
+            self._paint(self._layer, camera, bosses, self._layer.get_rect())
+            self._layer_key = key
+            self.rebuilds += 1
+        elif origin != self._origin:
+            layer = self._layer
+            w, h = size
+            dx, dy = self._origin[0] - origin[0], self._origin[1] - origin[1]
+            if abs(dx) >= w or abs(dy) >= h:
+                self._paint(layer, camera, bosses, layer.get_rect())
+            else:
+                layer.scroll(dx, dy)
+                # 横に動いた分の縦の帯と、縦に動いた分の横の帯が新しく映る
+                if dx:
+                    self._paint(layer, camera, bosses, pygame.Rect(0 if dx > 0 else w + dx, 0, abs(dx), h))
+                if dy:
+                    self._paint(layer, camera, bosses, pygame.Rect(0, 0 if dy > 0 else h + dy, w, abs(dy)))
+            self.scrolls += 1
+        self._origin = origin
+        return self._layer
+
+    def invalidate(self):
+        self._layer_key = None
+
+    def draw_hud(self, screen: pygame.Surface, hint: str = MAP_HINT_TEXT):
+        screen.blit(render_text(hint, 24, (255, 255, 0)), (10, 10))
+
+    def draw(self, screen: pygame.Surface, camera: Camera, bosses: BossGroup, player: Player):
+        screen.blit(self.static_layer(screen.get_size(), camera, bosses), (0, 0))
+        self.draw_hud(screen)
+        player.draw(screen, camera)
+
+
+# ====== 差分矩形描画 ======
+class DirtyRectRenderer:
+    """前フレームと今フレームの矩形を比べ、変化した部分だけを画面に反映する"""
+    def __init__(self, screen_size, full_flip_ratio: float = DIRTY_FULL_FLIP_RATIO):
+        self.screen_rect = pygame.Rect((0, 0), screen_size)
+        self.full_flip_ratio = full_flip_ratio
+        self._prev = {}  # key -> (rect, token)
+        self._cur = {}
+        self._scene_key = None
+        self._force_full = True
+        self._rects = None
+        self.full_flips = 0
+        self.partial_updates = 0
+        self.skipped_frames = 0
+
+    def begin(self, scene_key):
+        """フレーム開始。シーンが変わったら全画面描き直し"""
+        if scene_key != self._scene_key:
+            self._scene_key = scene_key
+            self._force_full = True
+        self._cur = {}
+        self._rects = None
+
+    def invalidate(self):
+        """画面を他のループが描き換えた時など、次フレームを必ず全画面にする"""
+        self._force_full = True
+
+    def track(self, key, rect, token=None):
+        """描画対象の位置を登録（rect=None は非表示、token は見た目の変化検出用）"""
+        self._cur[key] = (pygame.Rect(rect) if rect is not None else None, token)
+
+    def dirty_rects(self) -> List[pygame.Rect]:
+        if self._rects is None:
+            rects = []
+            for key in self._prev.keys() | self._cur.keys():
+                before = self._prev.get(key, (None, None))
+                after = self._cur.get(key, (None, None))
+                if before == after:
+                    continue
+                for r, _ in (before, after):
+                    if r is not None:
+                        r = r.clip(self.screen_rect)
+                        if r.width and r.height:
+                            rects.append(r)
+            self._rects = rects
+        return self._rects
+
+    def needs_full(self) -> bool:
+        if self._force_full:
+            return True
+        area = sum(r.width * r.height for r in self.dirty_rects())
+        return area > self.full_flip_ratio * self.screen_rect.width * self.screen_rect.height
+
+    def present(self):
+        """描画結果を画面に反映して、今フレームの矩形を次フレームの比較用に残す"""
+        if self.needs_full():
+            pygame.display.flip()
+            self.full_flips += 1
+        elif self.dirty_rects():
+            pygame.display.update(self.dirty_rects())
+            self.partial_updates += 1
+        else:
+            self.skipped_frames += 1
+        self._prev = self._cur
+        self._cur = {}
+        self._rects = None
+        self._force_full = False
+
+
+# ====== 描画バックエンド ======
+class SoftwareBackend:
+    """これまでの描き方：display のサーフェス（screen）に blit して flip する"""
+    name = "software"
+
+    def __init__(self, size, caption: str):
+        self.screen = pygame.display.set_mode(size)
+        pygame.display.set_caption(caption)
+
+    def present(self):
+        pygame.display.flip()
+
+
+class TextureBackend:
+    """
+    pygame._sdl2.video の Renderer で描く
+    draw_textures() に対応したシーン（マップ・バトル）は、背景チャンク・ボス・プレイヤー・バトルのキャラを
+    一度だけテクスチャにして（アトラスのスプライトはページごとに1枚）、毎フレームはコピーするだけにする
+    それ以外のシーンはこれまでどおり screen（ソフトウェアの面）に描き、1枚のテクスチャで送る
+    blit / blits / fill / get_size は Surface と同じ形なので、Surface に描く関数にそのまま渡せる
+    """
+    name = "texture"
+
+    def __init__(self, size, caption: str, require_accelerated: bool = None):
+        from pygame._sdl2 import video  # pygame のビルドによってはない（ImportError）
+        if require_accelerated is None:
+            require_accelerated = TEXTURE_REQUIRE_ACCELERATED
+        # convert()/convert_alpha() の画素形式を決めるための表示しない display（Renderer とは別の窓）
+        pygame.display.set_mode((1, 1), pygame.HIDDEN)
+        self.window = video.Window(caption, size=size)
+        try:
+            self.renderer = video.Renderer(self.window, accelerated=1 if require_accelerated else -1)
+        except Exception:
+            self.window.destroy()
+            raise
+        self.video = video
+        self.size = tuple(size)
+        self.screen = pygame.Surface(size).convert()
+        self._frame = video.Texture(self.renderer, size, streaming=True)
+        self._overlay = None
+        self._overlay_tex = None
+        # id(Surface) -> (弱参照, Texture, 版)。Surface が捨てられたら（ChunkedMap が追い出したチャンクなど）テクスチャも捨てる
+        self._textures = OrderedDict()
+        self._streams = {}  # 名前 -> (Texture, 最後に送った Surface)。毎回作り直す面用
+        self.uploads = 0  # Surface からテクスチャを作った回数
+
+    # --- Surface と同じ形の描画 ---
+    def get_size(self):
+        return self.size
+
+    def get_width(self) -> int:
+        return self.size[0]
+
+    def get_height(self) -> int:
+        return self.size[1]
+
+    def get_rect(self, **kw) -> pygame.Rect:
+        rect = pygame.Rect((0, 0), self.size)
+        for k, v in kw.items():
+            setattr(rect, k, v)
+        return rect
+
+    def texture(self, surf: pygame.Surface, revision: int = 0):
+        """surf のテクスチャ（revision が変わったら作り直す。あとから書き足すアトラスのページ用）"""
+        key = id(surf)
+        entry = self._textures.get(key)
+        if entry is not None and entry[0]() is surf and entry[2] == revision:
+            self._textures.move_to_end(key)
+            return entry[1]
+        tex = self.video.Texture.from_surface(self.renderer, surf)
+        self.uploads += 1
+
+        def forget(ref, key=key):
+            entry = self._textures.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._textures[key]
+        self._textures[key] = (weakref.ref(surf, forget), tex, revision)
+        self._textures.move_to_end(key)
+        if len(self._textures) > TEXTURE_CACHE_SIZE:
+            self._textures.popitem(last=False)
+        return tex
+
+    def blit(self, surf: pygame.Surface, dest, area=None):
+        # アトラスのスプライト（subsurface）はページのテクスチャから切り出す
+        parent = surf.get_parent()
+        if parent is not None:
+            ox, oy = surf.get_offset()
+            src = pygame.Rect(area) if area is not None else pygame.Rect(0, 0, *surf.get_size())
+            area = src.move(ox, oy).clip(pygame.Rect(ox, oy, *surf.get_size()))
+            surf = parent
+        tex = self.texture(surf, ATLAS.revision(surf))
+        alpha = surf.get_alpha()
+        tex.alpha = 255 if alpha is None else alpha
+        x, y = dest[0], dest[1]
+        src = pygame.Rect(area) if area is not None else pygame.Rect(0, 0, *surf.get_size())
+        dst = pygame.Rect(int(x), int(y), src.width, src.height)
+        tex.draw(srcrect=src, dstrect=dst)
+        return dst
+
+    def blit_stream(self, name: str, surf: pygame.Surface, dest):
+        """
+        何度も作り直す Surface（計測パネルなど）を name ごとに1枚のストリーミングテクスチャへ書き込んで描く
+        テクスチャのキャッシュには入れず、面が替わった時だけ update() する（大きさが変わったら作り直す）
+        """
+        tex, last = self._streams.get(name, (None, None))
+        if tex is None or (tex.width, tex.height) != surf.get_size():
+            tex = self.video.Texture(self.renderer, surf.get_size(), streaming=True)
+            tex.blend_mode = 1  # SDL_BLENDMODE_BLEND
+            last = None
+        if surf is not last:
+            tex.update(surf)
+            self.uploads += 1
+        self._streams[name] = (tex, surf)
+        tex.draw(dstrect=pygame.Rect(int(dest[0]), int(dest[1]), *surf.get_size()))
+
+    def blits(self, seq, doreturn=True):
+        rects = [self.blit(*item) for item in seq]
+        return rects if doreturn else None
+
+    def fill(self, color, rect=None):
+        self.renderer.draw_color = tuple(color) + (255,) * (4 - len(color))
+        if rect is None:
+            self.renderer.clear()
+        else:
+            self.renderer.fill_rect(pygame.Rect(rect))
+
+    # --- ソフトウェアの面を送る ---
+    def overlay(self) -> pygame.Surface:
+        """pygame.draw で描くもの（エフェクト）用の透明な面。描いたら draw_overlay() で重ねる"""
+        if self._overlay is None:
+            self._overlay = pygame.Surface(self.size, pygame.SRCALPHA).convert_alpha()
+            self._overlay_tex = self.video.Texture(self.renderer, self.size, streaming=True)
+            self._overlay_tex.blend_mode = 1  # SDL_BLENDMODE_BLEND
+        self._overlay.fill((0, 0, 0, 0))
+        return self._overlay
+
+    def draw_overlay(self):
+        self._overlay_tex.update(self._overlay)
+        self._overlay_tex.draw()
+
+    def draw_screen(self):
+        """screen に描いた1フレームを送る"""
+        self._frame.update(self.screen)
+        self._frame.draw()
+
+    def present(self):
+        self.renderer.present()
+
+    def stats(self) -> dict:
+        return {"textures": len(self._textures), "uploads": self.uploads}
+
+
+def create_backend(size, caption: str, name: str = None):
+    """name（既定は RENDER_BACKEND）の描画バックエンドを作る。texture が使えなければ software に戻す"""
+    name = name or RENDER_BACKEND
+    if name == "texture":
+        try:
+            return TextureBackend(size, caption)
+        except (ImportError, pygame.error, RuntimeError) as e:
+            print(f"テクスチャ描画が使えないのでソフトウェア描画にします（{e}）", file=sys.stderr)
+    return SoftwareBackend(size, caption)
+
+
+# ====== 計測（プロファイル） ======
+class _Scope:
+    __slots__ = ("profiler", "name", "t0")
+
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, (time.perf_counter() - self.t0) * 1000)
+
+
+class Profiler:
+    """
+    名前付きの計測区間（scope）の時間をフレームごとに足し合わせ、直近 window フレームの分布を持つ
+    "frame" はそのフレームの処理時間（入力待ち "wait" を除く）
+    """
+    def __init__(self, window: int = PROFILE_WINDOW):
+        self.window = window
+        self.overlay = False
+        self.frames = 0
+        self.worst = 0.0  # 起動してからの最悪フレーム（ms）
+        self.history = {}  # name -> deque(ms)
+        self.intervals = deque(maxlen=window)  # フレーム開始の間隔（ms）
+        self._frame = {}
+        self._last_begin = None
+        self._panel = None
+        self._export = None
+        self._writer = None
+
+    def scope(self, name: str) -> _Scope:
+        return _Scope(self, name)
+
+    def add(self, name: str, ms: float):
+        self._frame[name] = self._frame.get(name, 0.0) + ms
+
+    def begin_frame(self):
+        now = time.perf_counter()
+        if self._last_begin is not None:
+            self.intervals.append((now - self._last_begin) * 1000)
+        self._last_begin = now
+        self._frame = {}
+
+    def last(self, name: str) -> float:
+        """直前のフレームの name の時間（ms）"""
+        return self._frame.get(name, 0.0)
+
+    def end_frame(self):
+        for name, ms in self._frame.items():
+            h = self.history.get(name)
+            if h is None:
+                h = self.history[name] = deque(maxlen=self.window)
+            h.append(ms)
+        self.worst = max(self.worst, self._frame.get("frame", 0.0))
+        if self._export is not None:
+            self._write(self._frame)
+        self.frames += 1
+
+    # --- 集計 ---
+    def fps(self) -> float:
+        return 1000 * len(self.intervals) / sum(self.intervals) if self.intervals else 0.0
+
+    def summary(self) -> dict:
+        """scope ごとの p50/p95/p99/最大/平均（ms）"""
+        out = {}
+        for name, h in self.history.items():
+            a = np.fromiter(h, dtype=np.float64, count=len(h))
+            p50, p95, p99 = np.percentile(a, (50, 95, 99))
+            out[name] = {"n": len(a), "mean": float(a.mean()), "p50": float(p50),
+                         "p95": float(p95), "p99": float(p99), "max": float(a.max())}
+        return out
+
+    # --- 書き出し ---
+    def start_export(self, path: str):
+        """.csv は (frame, scope, ms) の縦持ち、.jsonl は1フレーム1行で書き出す"""
+        self.close()
+        self._export = open(path, "w", encoding="utf-8", newline="")
+        if path.endswith(".csv"):
+            self._writer = csv.writer(self._export)
+            self._writer.writerow(["frame", "scope", "ms"])
+        atexit.register(self.close)
+
+    def _write(self, frame: dict):
+        if self._writer is not None:
+            self._writer.writerows((self.frames, name, f"{ms:.4f}") for name, ms in frame.items())
+        else:
+            self._export.write(json.dumps({"frame": self.frames, "scopes": frame}) + "\n")
+
+    def close(self):
+        if self._export is not None:
+            self._export.close()
+            self._export = self._writer = None
+
+    # --- オーバーレイ ---
+    def draw_overlay(self, screen: pygame.Surface):
+        if self._panel is None or self.frames % PROFILE_OVERLAY_EVERY == 0:
+            self._panel = self._render_panel()
+        pos = (screen.get_width() - self._panel.get_width() - 8, 8)
+        if isinstance(screen, TextureBackend):
+            screen.blit_stream("profiler", self._panel, pos)  # 作り直すたびに新しいテクスチャを作らない
+        else:
+            screen.blit(self._panel, pos)
+
+    def _render_panel(self) -> pygame.Surface:
+        # 毎回数字が変わるので TEXT_CACHE は使わない（キャッシュを追い出してしまう）
+        font = get_font(None, 18)
+        color = (230, 255, 230)
+        stats = self.summary()
+        frame = stats.get("frame", {"p50": 0, "p95": 0, "p99": 0, "max": 0})
+        head = [
+            f"FPS {self.fps():.1f}   worst {self.worst:.2f} ms",
+            f"frame  p50 {frame['p50']:.2f}  p95 {frame['p95']:.2f}  p99 {frame['p99']:.2f}  max {frame['max']:.2f}",
         ]
+        # 表の部分は等幅でないフォントでも揃うよう、列ごとに右寄せで置く
+        rows = [("scope", "p50", "p95", "p99")]
+        scopes = sorted((n for n in stats if n not in ("frame", "wait")), key=lambda n: -stats[n]["p95"])
+        for name in scopes[:10]:
+            st = stats[name]
+            rows.append((name, f"{st['p50']:.2f}", f"{st['p95']:.2f}", f"{st['p99']:.2f}"))
+        head = [font.render(line, True, color) for line in head]
+        rows = [[font.render(cell, True, color) for cell in row] for row in rows]
+        name_w = max(r[0].get_width() for r in rows) + 10
+        col_w = max(c.get_width() for r in rows for c in r[1:]) + 10
+        line_h = font.get_linesize()
+        w = max([name_w + col_w * 3] + [h.get_width() for h in head]) + 12
+        panel = pygame.Surface((w, line_h * (len(head) + len(rows)) + 12), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 170))
+        y = 6
+        for h in head:
+            panel.blit(h, (6, y))
+            y += line_h
+        for row in rows:
+            panel.blit(row[0], (6, y))
+            for i, cell in enumerate(row[1:], 1):
+                panel.blit(cell, (6 + name_w + col_w * i - cell.get_width(), y))
+            y += line_h
+        return panel
+
+PROFILER = Profiler()
+
+
+class QualityGovernor:
+    """
+    直近のフレーム時間の p95 を見て、画質の段（QUALITY_TIERS の添字、0 が最高）を上げ下げする
+    エフェクトは作るときに tier を読むので、段を変えても再生中のエフェクトはそのまま
+    """
+    def __init__(self, tiers=QUALITY_TIERS, budget_ms: float = QUALITY_BUDGET_MS, window: int = QUALITY_WINDOW):
+        self.tiers = tiers
+        self.budget_ms = budget_ms
+        self.samples = deque(maxlen=window)
+        self.index = 0
+        self.locked = False
+        self.frames = 0
+        self.changes = []  # {"frame", "from", "to", "reason"} の履歴
+        self._up_after = 0  # このフレームまでは上げない
+
+    @property
+    def tier(self) -> dict:
+        return self.tiers[self.index]
+
+    @property
+    def name(self) -> str:
+        return self.tier["name"]
+
+    def observe(self, frame_ms: float):
+        """1フレームの処理時間を渡す（quality_governed なシーンの、動きのあるフレームだけ）"""
+        self.frames += 1
+        if self.locked:
+            return
+        self.samples.append(frame_ms)
+        if len(self.samples) < self.samples.maxlen:
+            return
+        p95 = float(np.percentile(self.samples, 95))
+        if p95 > self.budget_ms * QUALITY_DOWN_AT and self.index < len(self.tiers) - 1:
+            self.set_tier(self.index + 1, f"p95 {p95:.1f}ms > {self.budget_ms * QUALITY_DOWN_AT:.1f}ms")
+            self._up_after = self.frames + QUALITY_UP_HOLD
+        elif p95 < self.budget_ms * QUALITY_UP_AT and self.index > 0 and self.frames >= self._up_after:
+            self.set_tier(self.index - 1, f"p95 {p95:.1f}ms < {self.budget_ms * QUALITY_UP_AT:.1f}ms")
+
+    def set_tier(self, index: int, reason: str = "manual"):
+        index = max(0, min(len(self.tiers) - 1, index))
+        if index == self.index:
+            return
+        change = {"frame": self.frames, "from": self.name, "to": self.tiers[index]["name"], "reason": reason}
+        self.changes.append(change)
+        if PRINT_QUALITY_CHANGES:
+            print(f"画質 {change['from']} -> {change['to']}（{reason}）", file=sys.stderr)
+        self.index = index
+        self.samples.clear()
+
+    def lock(self, index: int = 0):
+        """段を固定して自動調整を止める（記録・再生やベンチマークで結果を揃える）"""
+        self.set_tier(index, "lock")
+        self.locked = True
+        self.samples.clear()
+
+    def unlock(self):
+        self.locked = False
+
+
+QUALITY = QualityGovernor()
+
+
+# ====== フレーム間隔の方針 ======
+class FramePacer:
+    """動いている間は fps 上限で回し、変化がない間は pygame.event.wait で入力が来るまで眠る"""
+    REDRAW_EVENTS = (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED, pygame.WINDOWSIZECHANGED)
+
+    def __init__(self, fps: int = TARGET_FPS, idle_wait_ms: int = IDLE_WAIT_MS):
+        self.clock = pygame.time.Clock()
+        self.fps = fps
+        self.idle_wait_ms = idle_wait_ms
+        self.redraw = True  # 次のフレームで描き直すか
+        self.dt = 0  # 前のフレームからの経過時間（ms）
+
+    def request_redraw(self):
+        self.redraw = True
+
+    def needs_redraw(self) -> bool:
+        return self.redraw
+
+    def drawn(self):
+        self.redraw = False
+
+    def events(self, animating: bool = False) -> list:
+        """次フレームのイベント。描き直しや動きがなければ入力（か idle_wait_ms）まで待つ"""
+        if animating or self.redraw:
+            self.dt = self.clock.tick(self.fps)
+            events = pygame.event.get()
+        else:
+            first = pygame.event.wait(self.idle_wait_ms)
+            events = [] if first.type == pygame.NOEVENT else [first]
+            events += pygame.event.get()
+            self.dt = self.clock.tick()
+        if any(e.type in self.REDRAW_EVENTS for e in events):
+            self.redraw = True
+        return events
+
+
+# ====== シーンスタック ======
+class Scene:
+    """シーンスタックに積む画面の基本形。入力と更新は一番上のシーンだけが受け取る"""
+    opaque = True  # False: 下のシーンの上に重ねて描く
+    animating = True  # False: 入力があるまで描き直さない（FramePacer の待機モード）
+    quality_governed = False  # True: このシーンのフレーム時間で画質の段（QUALITY）を調整する
+
+    def __init__(self):
+        self.stack = None  # push された SceneStack
+
+    def handle_event(self, event):
+        pass
+
+    def update(self, dt: int):
+        pass
 
     def draw(self, screen: pygame.Surface):
-        for b in self.bosses:
-            b.draw(screen)
+        pass
 
-    def alive_collision_with(self, rect: pygame.Rect):
-        for b in self.bosses:
-            if b.alive and rect.colliderect(b.rect):
-                return b
-        return None
+    def present(self, screen: pygame.Surface) -> bool:
+        """自分で描画と画面反映まで済ませたら True（差分矩形描画など）"""
+        return False
 
-    def any_alive(self) -> bool:
-        return any(b.alive for b in self.bosses)
+    def draw_textures(self, gpu: TextureBackend) -> bool:
+        """テクスチャ描画に対応したシーンは gpu に描いて True（False なら draw(screen) を1枚のテクスチャで送る）"""
+        return False
+
+    def on_enter(self):
+        pass
+
+    def on_exit(self):
+        pass
+
+    def on_resume(self):
+        """上のシーンが外れて、再び一番上になった"""
+        pass
+
+
+# ====== 入力の記録と再生 ======
+INPUT_LOG_MAGIC = b"PKRP"
+INPUT_LOG_VERSION = 1
+# ログに残すイベント（番号 = 並び順 + 1）。ゲームの進み方に関係しない描画系のイベントは残さない
+INPUT_LOG_EVENTS = (pygame.KEYDOWN, pygame.KEYUP, pygame.QUIT, pygame.WINDOWFOCUSLOST)
+_INPUT_LOG_CODES = {t: i + 1 for i, t in enumerate(INPUT_LOG_EVENTS)}
+
+def seed_rngs(seed: int):
+    """ゲームが使う乱数（random モジュールと PARTICLE_RNG）をまとめて初期化する"""
+    global PARTICLE_RNG
+    random.seed(seed)
+    PARTICLE_RNG = np.random.default_rng(seed)
+
+
+class InputRecorder:
+    """
+    1フレームごとの dt と入力イベントを、乱数の種と一緒にバイナリログへ書き出す
+    形式: "PKRP" + <version:u8> <seed:u64>、続いて zlib 圧縮した
+    フレームの並び <dt:u16> <イベント数:u16> { <種類:u8> <key:i32> }...
+    """
+    def __init__(self, path: str, seed: int = None):
+        self.seed = seed if seed is not None else int.from_bytes(os.urandom(8), "little") >> 1
+        self.frames = 0
+        self._file = open(path, "wb")
+        self._file.write(INPUT_LOG_MAGIC + struct.pack("<BQ", INPUT_LOG_VERSION, self.seed))
+        self._zip = zlib.compressobj(9)
+        atexit.register(self.close)
+
+    def write(self, dt: int, events):
+        kept = [(_INPUT_LOG_CODES[e.type], getattr(e, "key", 0)) for e in events if e.type in _INPUT_LOG_CODES]
+        buf = struct.pack("<HH", min(max(int(dt), 0), 0xFFFF), len(kept))
+        buf += b"".join(struct.pack("<Bi", code, key) for code, key in kept)
+        self._file.write(self._zip.compress(buf))
+        self.frames += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.write(self._zip.flush())
+            self._file.close()
+            self._file = None
+
+
+class InputReplay:
+    """InputRecorder のログを1フレームずつ (dt, events) で返す。realtime=True なら記録時の間隔で返す"""
+    def __init__(self, path: str, realtime: bool = False):
+        with open(path, "rb") as f:
+            data = f.read()
+        if data[:4] != INPUT_LOG_MAGIC:
+            raise ValueError(f"{path} は入力ログではありません")
+        version, self.seed = struct.unpack_from("<BQ", data, 4)
+        if version != INPUT_LOG_VERSION:
+            raise ValueError(f"{path} のバージョン {version} には対応していません")
+        self._data = zlib.decompress(data[4 + struct.calcsize("<BQ"):])
+        self._pos = 0
+        self.realtime = realtime
+        self.frames = 0
+        self._last = None
+
+    @property
+    def done(self) -> bool:
+        return self._pos >= len(self._data)
+
+    def next_frame(self):
+        """次のフレームの (dt, events)。最後まで読んだら None"""
+        if self.done:
+            return None
+        dt, n = struct.unpack_from("<HH", self._data, self._pos)
+        self._pos += 4
+        events = []
+        for _ in range(n):
+            code, key = struct.unpack_from("<Bi", self._data, self._pos)
+            self._pos += 5
+            type_ = INPUT_LOG_EVENTS[code - 1]
+            events.append(pygame.event.Event(type_, key=key) if type_ in (pygame.KEYDOWN, pygame.KEYUP)
+                          else pygame.event.Event(type_))
+        if self.realtime:
+            if self._last is not None:
+                wait = dt - (time.perf_counter() - self._last) * 1000
+                if wait > 0:
+                    pygame.time.wait(int(wait))
+            self._last = time.perf_counter()
+        self.frames += 1
+        return dt, events
+
+
+class KeyState:
+    """
+    KEYDOWN/KEYUP から組み立てた押しっぱなしのキー（pygame.key.get_pressed() と同じく [key] で引ける）
+    イベントだけで決まるので、スクリプト入力でも同じように動く
+    """
+    def __init__(self):
+        self.down = set()
+
+    def __getitem__(self, key: int) -> bool:
+        return key in self.down
+
+    def feed(self, event):
+        if event.type == pygame.KEYDOWN:
+            self.down.add(event.key)
+        elif event.type == pygame.KEYUP:
+            self.down.discard(event.key)
+        elif event.type == pygame.WINDOWFOCUSLOST:
+            self.down.clear()
+
+
+class SceneStack:
+    """メインループ・時計・イベント配送を1つにまとめ、積まれたシーンを切り替える"""
+    def __init__(self, screen: pygame.Surface, pacer: FramePacer = None, backend=None):
+        self.screen = screen
+        self.pacer = pacer or FramePacer()
+        self.backend = backend  # None は display のサーフェスに描いて flip
+        self.keys = KeyState()
+        self.recorder = None  # InputRecorder
+        self.replay = None  # InputReplay
+        self.scenes: List[Scene] = []
+        self.frames = 0
+
+    @property
+    def top(self) -> Scene:
+        return self.scenes[-1] if self.scenes else None
+
+    def push(self, scene: Scene):
+        scene.stack = self
+        self.scenes.append(scene)
+        scene.on_enter()
+        self.pacer.request_redraw()
+
+    def pop(self) -> Scene:
+        scene = self.scenes.pop()
+        scene.on_exit()
+        if self.scenes:
+            self.top.on_resume()
+        self.pacer.request_redraw()
+        return scene
+
+    def replace(self, scene: Scene):
+        """一番上のシーンを差し替える（下のシーンには戻らない）"""
+        self.scenes.pop().on_exit()
+        self.push(scene)
+
+    def visible(self) -> List[Scene]:
+        """描画するシーン（一番上から下へ、不透明なシーンまで）"""
+        i = len(self.scenes) - 1
+        while i > 0 and not self.scenes[i].opaque:
+            i -= 1
+        return self.scenes[i:]
+
+    def step(self, events=None, dt: int = None):
+        """1フレーム分：イベント配送 → 更新 → 描画（events/dt を渡すと時計を使わずにその入力で進める）"""
+        prof = PROFILER
+        prof.begin_frame()
+        if events is None and self.replay is not None:
+            with prof.scope("wait"):
+                frame = self.replay.next_frame()
+                # 再生中も窓は応答させる（閉じるボタンだけは効く）
+                if any(e.type == pygame.QUIT for e in pygame.event.get()):
+                    self.quit()
+            if frame is None:
+                return
+            recorded_dt, events = frame
+            if dt is None:
+                dt = recorded_dt
+        if events is None:
+            with prof.scope("wait"):
+                events = self.pacer.events(animating=self.top.animating or prof.overlay)
+        if dt is None:
+            dt = self.pacer.dt
+        if self.recorder is not None:
+            self.recorder.write(dt, events)
+        with prof.scope("frame"):
+            with prof.scope("events"):
+                for event in events:
+                    if event.type in (pygame.QUIT, pygame.WINDOWCLOSE):
+                        # テクスチャ描画では表示しない display の窓が残るので、窓を閉じたら QUIT を待たずに終わる
+                        self.quit()
+                    self.keys.feed(event)
+                    self.pacer.request_redraw()
+                    if event.type == pygame.KEYDOWN and event.key == PROFILE_OVERLAY_KEY:
+                        self.toggle_overlay()
+                        continue
+                    if self.scenes:
+                        self.top.handle_event(event)
+            with prof.scope("update"):
+                if self.scenes:
+                    self.top.update(dt)
+            if self.scenes:
+                self.render()
+        self.frames += 1
+        prof.end_frame()
+        if self.scenes and self.top.quality_governed and self.top.animating:
+            QUALITY.observe(prof.last("frame"))
+
+    def record(self, path: str, seed: int = None):
+        """これ以降の入力を path に記録する（乱数の種も決めてログに残す）"""
+        self.recorder = InputRecorder(path, seed)
+        seed_rngs(self.recorder.seed)
+        QUALITY.lock()  # パーティクル数が変わると乱数の進みが変わり、再生と合わなくなる
+
+    def play(self, path: str, realtime: bool = False):
+        """pygame のイベントの代わりに path のログの入力で進める（乱数の種もログの物にする）"""
+        self.replay = InputReplay(path, realtime)
+        seed_rngs(self.replay.seed)
+        QUALITY.lock()
+
+    def quit(self):
+        PROFILER.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        pygame.quit(); sys.exit()
+
+    def toggle_overlay(self):
+        PROFILER.overlay = not PROFILER.overlay
+        if self.scenes:
+            # オーバーレイの跡が残らないよう、一番上のシーンに全画面から描き直してもらう
+            self.top.on_resume()
+
+    def render(self):
+        visible = self.visible()
+        overlay = PROFILER.overlay
+        if not self.pacer.needs_redraw() and not overlay and not any(s.animating for s in visible):
+            return
+        gpu = self.backend if isinstance(self.backend, TextureBackend) else None
+        if len(visible) == 1 and not overlay and gpu is None:
+            with PROFILER.scope("draw"):
+                presented = visible[0].present(self.screen)
+            if presented:
+                self.pacer.drawn()
+                return
+        with PROFILER.scope("draw"):
+            if gpu is None or not (len(visible) == 1 and visible[0].draw_textures(gpu)):
+                for scene in visible:
+                    scene.draw(self.screen)
+                if gpu is not None:
+                    gpu.draw_screen()
+        if overlay:
+            with PROFILER.scope("overlay"):
+                PROFILER.draw_overlay(gpu or self.screen)
+        with PROFILER.scope("flip"):
+            if self.backend is not None:
+                self.backend.present()
+            else:
+                pygame.display.flip()
+        self.pacer.drawn()
+
+    def run(self):
+        if PROFILE_EXPORT:
+            PROFILER.start_export(PROFILE_EXPORT)
+        while self.scenes and not (self.replay is not None and self.replay.done):
+            self.step()
 
 
 # ====== ペット（ふれあい）シーン ======
-class PetScene:
-    def __init__(self, folder: str, screen: pygame.Surface):
+PET_HEIGHT_RATIO = 0.6  # 画面の高さに対するペットの高さ
+PET_BG_COLOR = (255, 200, 220)
+PET_TEXT_COLOR = (100, 0, 50)
+PET_GUIDE = ["A：なでる", "Q：なぐる（連打で強）", "F：もどる"]
+PET_FADE_MS = 150  # 表情を切り替えるクロスフェードの時間
+PET_FADE_STEPS = 6  # クロスフェードの途中のコマ数（最初に使うときに作って取っておく）
+PET_FADE_CACHE = 6  # 途中のコマを取っておく（切り替え前, 切り替え後）の組の数
+
+class PetScene(Scene):
+    """
+    F で開くふれあい画面（F で戻る / B でインベントリ）
+    背景と操作説明の層、表情ごとの縮小済みの絵を画面サイズごとに一度だけ作り、毎フレームは2回の blit で描く
+    """
+    def __init__(self, folder: str, screen: pygame.Surface, open_inventory=None):
+        super().__init__()
         self.screen = screen
+        self.open_inventory = open_inventory
         self.folder = folder
         self.state = "normal"
-        self.last_q_press_time = 0
+        self.clock_ms = 0  # update の dt を足したシーン内の時計（記録・再生で同じ結果になるよう壁時計は使わない）
+        self.last_q_press_time = -1000
         self.action_start_time = 0
-        self.font = get_jp_font(28)
-        self.images = {
-            "normal": pygame.image.load(os.path.join(folder, "1.png")).convert_alpha(),
-            "pet": pygame.image.load(os.path.join(folder, "9.png")).convert_alpha(),
-            "hit": pygame.image.load(os.path.join(folder, "7.png")).convert_alpha(),
-            "hit_strong": pygame.image.load(os.path.join(folder, "8.png")).convert_alpha(),
+        self.paths = {
+            "normal": os.path.join(folder, "1.png"),
+            "pet": os.path.join(folder, "9.png"),
+            "hit": os.path.join(folder, "7.png"),
+            "hit_strong": os.path.join(folder, "8.png"),
         }
+        self.fade = None  # (切り替え前, 切り替え後, 開始時刻)
+        self.size = None
+        self.layer = None  # 背景＋操作説明（不透明）
+        self.face_rect = None  # 表情を描く範囲（どの表情も収まる大きさ）
+        self.faces = {}  # 状態 -> face_rect の大きさの不透明な絵（背景色込み）
+        self._fades = OrderedDict()  # (切り替え前, 切り替え後) -> 途中のコマのリスト
+
+    @property
+    def animating(self) -> bool:
+        # ふつうの顔で止まっている間は入力があるまで描き直さない
+        return self.state != "normal" or self.fade is not None
+
+    def _build(self, size):
+        """画面サイズに合わせて層と表情を作り直す"""
+        sw, sh = self.size = size
+        layer = pygame.Surface(size).convert()
+        layer.fill(PET_BG_COLOR)
+        for i, line in enumerate(PET_GUIDE):
+            msg = render_text(line, 28, PET_TEXT_COLOR)
+            layer.blit(msg, (sw - msg.get_width() - 20, 20 + i * 40))
+        self.layer = layer
+
+        # 表情は背景色込みで faces に焼き込むので、縮小した絵はアトラスにもキャッシュにも残さない
+        scaled = {}
+        for state, path in self.paths.items():
+            iw, ih = ASSETS.get(path).get_size()  # 元サイズの表示形式版（先読みで作ってある。縮小の元にもなる）
+            f = (sh * PET_HEIGHT_RATIO) / ih
+            scaled[state] = ASSETS.get(path, (int(iw * f), int(ih * f)))
+        w = max(img.get_width() for img in scaled.values())
+        h = max(img.get_height() for img in scaled.values())
+        self.face_rect = pygame.Rect(0, 0, w, h)
+        self.face_rect.center = (sw // 2, sh // 2)
+        self.faces = {}
+        for state, img in scaled.items():
+            face = layer.subsurface(self.face_rect).copy()
+            face.blit(img, img.get_rect(center=(w // 2, h // 2)))
+            self.faces[state] = face
+            ASSETS.release(img)
+        self._fades.clear()
+
+    def _fade_frames(self, src: str, dst: str) -> List[pygame.Surface]:
+        key = (src, dst)
+        frames = self._fades.get(key)
+        if frames is not None:
+            self._fades.move_to_end(key)
+            return frames
+        frames = []
+        top = self.faces[dst].copy()
+        for i in range(PET_FADE_STEPS):
+            frame = self.faces[src].copy()
+            top.set_alpha(255 * (i + 1) // (PET_FADE_STEPS + 1))
+            frame.blit(top, (0, 0))
+            frames.append(frame)
+        self._fades[key] = frames
+        if len(self._fades) > PET_FADE_CACHE:
+            self._fades.popitem(last=False)
+        return frames
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.fade = (self.state, state, self.clock_ms)
+        self.state = state
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_a:
-                self.state = "pet"
-                self.action_start_time = time.time()
+            if event.key == pygame.K_f:
+                self.stack.pop()
+            elif event.key == pygame.K_b and self.open_inventory:
+                self.open_inventory()
+            elif event.key == pygame.K_a:
+                self._set_state("pet")
+                self.action_start_time = self.clock_ms
             elif event.key == pygame.K_q:
-                now = time.time()
-                if now - self.last_q_press_time < 0.4:
-                    self.state = "hit_strong"
+                now = self.clock_ms
+                if now - self.last_q_press_time < 400:
+                    self._set_state("hit_strong")
                 else:
-                    self.state = "hit"
+                    self._set_state("hit")
                 self.last_q_press_time = now
                 self.action_start_time = now
 
-    def update(self):
-        if self.state != "normal" and time.time() - self.action_start_time > 3:
-            self.state = "normal"
-
-    def draw(self):
-        screen = self.screen
-        screen.fill((255, 200, 220))
-        sw, sh = screen.get_size()
-        pet_img = self.images[self.state]
-        ih, iw = pet_img.get_height(), pet_img.get_width()
-        scale_factor = (sh * 0.6) / ih
-        scaled = pygame.transform.scale(pet_img, (int(iw * scale_factor), int(ih * scale_factor)))
-        rect = scaled.get_rect(center=(sw // 2, sh // 2))
-        screen.blit(scaled, rect)
-        msg1 = self.font.render("A：なでる", True, (100, 0, 50))
-        msg2 = self.font.render("Q：なぐる（連打で強）", True, (100, 0, 50))
-        msg3 = self.font.render("F：もどる", True, (100, 0, 50))
-        screen.blit(msg1, (sw - msg1.get_width() - 20, 20))
-        screen.blit(msg2, (sw - msg2.get_width() - 20, 60))
-        screen.blit(msg3, (sw - msg3.get_width() - 20, 100))
+    def update(self, dt: int):
+        self.clock_ms += dt
+        if self.state != "normal" and self.clock_ms - self.action_start_time > 3000:
+            self._set_state("normal")
+        if self.fade is not None and self.clock_ms - self.fade[2] >= PET_FADE_MS:
+            self.fade = None
+            if self.stack is not None:
+                self.stack.pacer.request_redraw()  # 止まる前に切り替え後の顔を描く
+
+    def draw(self, screen: pygame.Surface):
+        if self.size != screen.get_size():
+            self._build(screen.get_size())
+        screen.blit(self.layer, (0, 0))
+        face = self.faces[self.state]
+        if self.fade is not None:
+            src, dst, start = self.fade
+            i = (self.clock_ms - start) * PET_FADE_STEPS // PET_FADE_MS
+            if i < PET_FADE_STEPS:
+                face = self._fade_frames(src, dst)[i]
+        screen.blit(face, self.face_rect)
 
 
 # ====== バトル相性 ======
+# 攻撃側タイプ -> {防御側タイプ: 倍率}（書いていない組み合わせは 1.0）
+TYPE_ADVANTAGE = {
+    "ほのお": {"みず": 0.5, "くさ": 2.0, "でんき": 1.0},
+    "みず": {"ほのお": 2.0, "でんき": 0.5, "くさ": 0.5},
+    "でんき": {"みず": 2.0, "ほのお": 1.0, "くさ": 1.0},
+    "くさ": {"みず": 2.0, "ほのお": 0.5, "でんき": 1.0},
+    "ノーマル": {},
+}
+
+class TypeChart:
+    """
+    タイプを小さな整数 ID にし、相性を (攻撃側, 防御側) の行列で持つ
+    matrix[攻撃側ID, 防御側ID] が倍率
+    表にないタイプは neutral（最後の ID、行も列もすべて 1.0）になり、ふつうの相性で戦う
+    """
+    def __init__(self, names: List[str], matrix: np.ndarray):
+        self.names = list(names)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        n = len(self.names)
+        self.neutral = n
+        self.matrix = np.ones((n + 1, n + 1), dtype=np.float64)
+        self.matrix[:n, :n] = matrix
+
+    @classmethod
+    def from_dict(cls, advantage: dict) -> "TypeChart":
+        names = list(advantage)
+        for row in advantage.values():
+            names += [t for t in row if t not in names]
+        chart = cls(names, np.ones((len(names), len(names))))
+        for atk, row in advantage.items():
+            for dfn, mult in row.items():
+                chart.matrix[chart.index[atk], chart.index[dfn]] = mult
+        return chart
+
+    @classmethod
+    def load(cls, path: str) -> "TypeChart":
+        """TYPE_ADVANTAGE と同じ形の JSON（{攻撃側: {防御側: 倍率}}）から読む"""
+        with open(path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+    def id(self, name: str) -> int:
+        return self.index.get(name, self.neutral)
+
+    def ids(self, names) -> np.ndarray:
+        return np.array([self.id(n) for n in names], dtype=np.intp)
+
+    def multiplier(self, atk_id: int, dfn_id: int) -> float:
+        return float(self.matrix[atk_id, dfn_id])
+
+TYPE_CHART = TypeChart.from_dict(TYPE_ADVANTAGE)
+
 def get_type_multiplier(move_type: str, target_type: str) -> float:
-    advantage = {
-        "ほのお": {"みず": 0.5, "くさ": 2.0, "でんき": 1.0},
-        "みず": {"ほのお": 2.0, "でんき": 0.5, "くさ": 0.5},
-        "でんき": {"みず": 2.0, "ほのお": 1.0, "くさ": 1.0},
-        "くさ": {"みず": 2.0, "ほのお": 0.5, "でんき": 1.0},
-        "ノーマル": {},
-    }
-    if move_type in advantage and target_type in advantage[move_type]:
-        return advantage[move_type][target_type]
-    return 1.0
+    return TYPE_CHART.multiplier(TYPE_CHART.id(move_type), TYPE_CHART.id(target_type))
+
+
+# ====== バトル規則（描画なし） ======
+BATTLE_MAX_HP = 100
+ENEMY_DAMAGE_RANGE = (8, 22)  # 敵の攻撃ダメージ（両端を含む）
+
+# 技：名前, 基本威力, タイプ, エフェクト種別
+# エフェクト種別: "tackle", "quick", "flame", "water"
+BATTLE_MOVES = [
+    ("たいあたり",   10, "ノーマル", "tackle"),
+    ("かえんほうしゃ", 25, "ほのお",   "flame"),
+    ("でんこうせっか", 18, "でんき",   "quick"),
+    ("みずでっぽう",   20, "みず",     "water"),
+]
+
+class MoveTable:
+    """
+    技の一覧（タイプは TypeChart の ID で持つ）
+    [i] で (名前, 基本威力, タイプ, エフェクト種別) を返すので BATTLE_MOVES と同じように使える
+    """
+    def __init__(self, moves, chart: TypeChart = None):
+        self.chart = chart or TYPE_CHART
+        self.moves = [tuple(m) for m in moves]
+        self.names = [m[0] for m in self.moves]
+        self.base = np.array([m[1] for m in self.moves], dtype=np.float64)
+        self.type_ids = self.chart.ids(m[2] for m in self.moves)
+
+    @classmethod
+    def load(cls, path: str, chart: TypeChart = None) -> "MoveTable":
+        """[[名前, 基本威力, タイプ, エフェクト種別], ...] の JSON から読む"""
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), chart)
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __getitem__(self, index):
+        return self.moves[index]
+
+    def __iter__(self):
+        return iter(self.moves)
+
+    def multipliers(self, target_ids) -> np.ndarray:
+        """(技の数, 相手の数) の倍率"""
+        return self.chart.matrix[np.ix_(self.type_ids, np.asarray(target_ids, dtype=np.intp))]
+
+    def damage_table(self, target_ids) -> np.ndarray:
+        """(技の数, 相手の数) のダメージ（基本威力×倍率の切り捨て）"""
+        return np.floor(self.base[:, None] * self.multipliers(target_ids)).astype(np.int32)
+
+MOVES = MoveTable(BATTLE_MOVES)
+
+class BattleEngine:
+    """
+    1戦ぶんのバトル規則と状態（pygame に依存しない）
+    rng は randint を持つもの（random モジュール、random.Random(seed) など）
+    enemy_type_id を渡すと（Boss.type_id など）タイプ名から引き直さない
+    """
+    def __init__(self, enemy_type: str, rng=None, moves=None, enemy_type_id: int = None):
+        self.enemy_type = enemy_type
+        self.rng = rng if rng is not None else random
+        if moves is None:
+            moves = MOVES
+        elif not isinstance(moves, MoveTable):
+            moves = MoveTable(moves)
+        self.moves = moves
+        # この相手に対するダメージと倍率は最初に一度だけ引いておく
+        target = [moves.chart.id(enemy_type) if enemy_type_id is None else enemy_type_id]
+        self._damage = moves.damage_table(target)[:, 0].tolist()
+        self._mult = moves.multipliers(target)[:, 0].tolist()
+        self.player_hp = self.enemy_hp = BATTLE_MAX_HP
+        self.turns = 0
+        self.result = None  # None / "win" / "lose"
+
+    def damage(self, index: int) -> Tuple[int, float]:
+        """技 index を敵に当てた時の（ダメージ, 倍率）"""
+        return self._damage[index], self._mult[index]
+
+    def player_move(self, index: int) -> Tuple[int, float]:
+        dmg, mult = self.damage(index)
+        self.turns += 1
+        self.enemy_hp -= dmg
+        if self.enemy_hp <= 0:
+            self.result = "win"
+        return dmg, mult
+
+    def enemy_move(self) -> int:
+        dmg = self.rng.randint(*ENEMY_DAMAGE_RANGE)
+        self.player_hp -= dmg
+        if self.player_hp <= 0:
+            self.result = "lose"
+        return dmg
+
+    def play(self, policy) -> str:
+        """policy(engine) が返す技の番号で決着まで進め、結果を返す"""
+        while self.result is None:
+            self.player_move(policy(self))
+            if self.result is None:
+                self.enemy_move()
+        return self.result
 
 
 # ====== バトルエフェクト（下コードを統合） ======
 class EffectBase:
+    """update() で1コマ（1/SIM_HZ 秒）進め、draw() は alpha（前のコマ→今のコマの割合）で間を補間して描く"""
     def __init__(self):
         self.alive = True
     def update(self) -> bool:
         return self.alive
-    def draw(self, surf):
+    def draw(self, surf, alpha: float = 1.0):
         pass
 
 class TackleEffect(EffectBase):
@@ -326,11 +2287,12 @@ class TackleEffect(EffectBase):
         return self.alive
 
 class QuickAttackEffect(EffectBase):
-    """でんこうせっか：ジグザグ線を複数本"""
-    def __init__(self, src, dst, frames=20):
+    """でんこうせっか：ジグザグ線を複数本（passes=1 だと芯の白線を省く）"""
+    def __init__(self, src, dst, frames=20, passes: int = 2):
         super().__init__()
         self.src, self.dst = src, dst
         self.f, self.frames = 0, frames
+        self.passes = passes
         self.paths = []
     def update(self):
         self.f += 1
@@ -347,101 +2309,271 @@ class QuickAttackEffect(EffectBase):
                     pts.append((x, y))
                 self.paths.append(pts)
         return self.alive
-    def draw(self, surf):
+    def draw(self, surf, alpha: float = 1.0):
         for pts in self.paths:
             pygame.draw.lines(surf, (255, 255, 100), False, pts, 4)
-            pygame.draw.lines(surf, (255, 255, 255), False, pts, 2)
+            if self.passes > 1:
+                pygame.draw.lines(surf, (255, 255, 255), False, pts, 2)
+
+# ====== パーティクル（NumPy） ======
+PARTICLE_RNG = np.random.default_rng()
+
+class ParticleSystem:
+    """位置・速度・寿命を NumPy 配列（structure-of-arrays）で持つパーティクル群（prev は1コマ前の位置）"""
+    def __init__(self, capacity: int = 256):
+        self.pos = np.zeros((capacity, 2), np.float32)
+        self.prev = np.zeros((capacity, 2), np.float32)
+        self.vel = np.zeros((capacity, 2), np.float32)
+        self.life = np.zeros(capacity, np.float32)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _reserve(self, extra: int):
+        need = self.n + extra
+        cap = len(self.life)
+        if need <= cap:
+            return
+        while cap < need:
+            cap *= 2
+        for name in ("pos", "prev", "vel", "life"):
+            old = getattr(self, name)
+            arr = np.zeros((cap,) + old.shape[1:], old.dtype)
+            arr[:self.n] = old[:self.n]
+            setattr(self, name, arr)
+
+    def emit(self, pos, vel, life):
+        """pos, vel: (k, 2) 配列 / life: (k,) 配列 のパーティクルを追加"""
+        k = len(life)
+        if k == 0:
+            return
+        self._reserve(k)
+        n = self.n
+        self.pos[n:n + k] = pos
+        self.prev[n:n + k] = pos
+        self.vel[n:n + k] = vel
+        self.life[n:n + k] = life
+        self.n = n + k
+
+    def step(self, gravity: float = 0.0) -> np.ndarray:
+        """1コマ進めて寿命の尽きたものを詰めて取り除き、その位置を返す"""
+        n = self.n
+        if n == 0:
+            return self.pos[:0].copy()
+        pos, vel, life = self.pos[:n], self.vel[:n], self.life[:n]
+        self.prev[:n] = pos
+        pos += vel
+        if gravity:
+            vel[:, 1] += gravity
+        life -= 1
+        dead = life <= 0
+        if not dead.any():
+            return self.pos[:0].copy()
+        dead_pos = pos[dead]
+        keep = ~dead
+        k = int(keep.sum())
+        self.pos[:k] = pos[keep]
+        self.prev[:k] = self.prev[:n][keep]
+        self.vel[:k] = vel[keep]
+        self.life[:k] = life[keep]
+        self.n = k
+        return dead_pos
+
+    def render_pos(self, alpha: float = 1.0) -> np.ndarray:
+        """描画する位置（1コマ前→今を alpha で補間、整数）"""
+        n = self.n
+        if alpha >= 1.0:
+            return self.pos[:n].astype(int)
+        prev = self.prev[:n]
+        return (prev + (self.pos[:n] - prev) * alpha).astype(int)
+
+    def clear(self):
+        self.n = 0
+
+
+class SpriteStamps:
+    """色・半径・アルファごとに円を事前描画しておき、毎フレームは blit するだけにする"""
+    def __init__(self):
+        self._stamps = {}
+
+    def circle(self, color, radius: int, alpha: int = 255) -> pygame.Surface:
+        key = (color, radius, alpha)
+        stamp = self._stamps.get(key)
+        if stamp is None:
+            d = radius * 2 + 1
+            if alpha >= 255:
+                # 不透明はカラーキーの方がピクセルアルファより速い
+                stamp = pygame.Surface((d, d))
+                stamp.fill((255, 0, 255))
+                pygame.draw.circle(stamp, color, (radius, radius), radius)
+                stamp.set_colorkey((255, 0, 255))
+            else:
+                stamp = pygame.Surface((d, d), pygame.SRCALPHA)
+                pygame.draw.circle(stamp, (*color, alpha), (radius, radius), radius)
+            self._stamps[key] = stamp
+        return stamp
+
+
+STAMPS = SpriteStamps()
+
 
 class FlamethrowerEffect(EffectBase):
-    """かえんほうしゃ：炎→煙のパーティクル"""
-    def __init__(self, src, dst, frames=40):
+    """かえんほうしゃ：炎→煙のパーティクル（density でパーティクル数を倍率指定、smoke=False で煙を出さない）"""
+    # 炎の色ゆらぎ（毎フレームこの中からランダムに選ぶ）
+    FLAME_COLORS = [(255, 100 + i * 100 // 7, 30 + (i * 5 % 8) * 30 // 7) for i in range(8)]
+
+    def __init__(self, src, dst, frames=40, density: float = 1.0, smoke: bool = True):
         super().__init__()
         self.src, self.dst = src, dst
         self.f, self.frames = 0, frames
-        self.flames = []
-        self.smoke = []
+        self.density = density
+        self.emit_smoke = smoke
+        self.flames = ParticleSystem()
+        self.smoke = ParticleSystem()
         self._spawn(25)
     def _spawn(self, n):
+        n = max(1, int(n * self.density))
+        rng = PARTICLE_RNG
         (ux, uy), _ = _dir(self.src, self.dst)
-        base = math.atan2(uy, ux)
-        for _ in range(n):
-            ang = base + random.uniform(-0.4, 0.4)
-            spd = random.uniform(4, 8)
-            vx, vy = math.cos(ang) * spd, math.sin(ang) * spd
-            life = random.randint(20, 35)
-            self.flames.append([self.src[0], self.src[1], vx, vy, life])
+        ang = math.atan2(uy, ux) + rng.uniform(-0.4, 0.4, n)
+        spd = rng.uniform(4, 8, n)
+        vel = np.stack([np.cos(ang) * spd, np.sin(ang) * spd], axis=1)
+        self.flames.emit(self.src, vel, rng.integers(20, 36, n))
     def update(self):
         self.f += 1
         if self.f <= self.frames and self.f % 2 == 0:
             self._spawn(5)
-        new_flames, new_smoke = [], []
-        for p in self.flames:
-            p[0] += p[2]; p[1] += p[3]
-            p[3] += 0.05
-            p[4] -= 1
-            if p[4] > 0:
-                new_flames.append(p)
-            else:
-                new_smoke.append([p[0], p[1], random.uniform(-0.5, 0.5), -1.0, 40])
-        self.flames = new_flames
-        self.smoke = self.smoke + new_smoke
-        self.smoke = [s for s in self.smoke if s[4] > 0]
-        for s in self.smoke:
-            s[0] += s[2]; s[1] += s[3]
-            s[4] -= 1
+        self.smoke.step()
+        # 燃え尽きた炎はその位置から煙になる
+        dead = self.flames.step(gravity=0.05)
+        k = len(dead)
+        if k and self.emit_smoke:
+            vel = np.stack([PARTICLE_RNG.uniform(-0.5, 0.5, k), np.full(k, -1.0)], axis=1)
+            self.smoke.emit(dead, vel, np.full(k, 40))
         if self.f > self.frames and not self.flames and not self.smoke:
             self.alive = False
         return self.alive
-    def draw(self, surf):
-        for x, y, _, _, life in self.flames:
-            col = (255, random.randint(100, 200), random.randint(30, 60))
-            r = max(2, int(6 * (life / 35)))
-            pygame.draw.circle(surf, col, (int(x), int(y)), r)
-        for x, y, _, _, life in self.smoke:
-            alpha = int(180 * (life / 40))
-            r = int(8 * (life / 40))
-            s = pygame.Surface((r * 2, r * 2), pygame.SRCALPHA)
-            pygame.draw.circle(s, (80, 80, 80, alpha), (r, r), r)
-            surf.blit(s, (x - r, y - r))
+    def draw(self, surf, alpha: float = 1.0):
+        n = self.flames.n
+        if n:
+            pos = self.flames.render_pos(alpha)
+            radius = np.maximum(2, (6 * self.flames.life[:n] / 35).astype(int))
+            colors = PARTICLE_RNG.integers(0, len(self.FLAME_COLORS), n)
+            surf.blits([(STAMPS.circle(self.FLAME_COLORS[c], r), (x - r, y - r))
+                        for (x, y), r, c in zip(pos.tolist(), radius.tolist(), colors.tolist())],
+                       doreturn=False)
+        n = self.smoke.n
+        if n:
+            pos = self.smoke.render_pos(alpha)
+            life = self.smoke.life[:n]
+            fade = (180 * life / 40).astype(int)
+            radius = (8 * life / 40).astype(int)
+            surf.blits([(STAMPS.circle((80, 80, 80), r, a), (x - r, y - r))
+                        for (x, y), r, a in zip(pos.tolist(), radius.tolist(), fade.tolist()) if r > 0],
+                       doreturn=False)
 
 class WaterGunEffect(EffectBase):
-    """みずでっぽう：水流の線＋水しぶき"""
-    def __init__(self, src, dst, frames=45):
+    """みずでっぽう：水流の線＋水しぶき（density でパーティクル数を倍率指定、passes=1 だと芯の線を省く）"""
+    def __init__(self, src, dst, frames=45, density: float = 1.0, passes: int = 2):
         super().__init__()
         self.src, self.dst, self.f, self.frames = src, dst, 0, frames
-        self.drops = []
+        self.density = density
+        self.passes = passes
+        self.drops = ParticleSystem()
     def update(self):
         self.f += 1
         (ux, uy), dist = _dir(self.src, self.dst)
         if self.f <= self.frames:
-            for _ in range(8):
-                rand_dist = random.uniform(0, dist)
-                px = self.src[0] + ux * rand_dist
-                py = self.src[1] + uy * rand_dist
-                vx = ux * random.uniform(3, 5) + random.uniform(-0.8, 0.8)
-                vy = uy * random.uniform(3, 5) + random.uniform(-0.8, 0.8)
-                life = random.randint(10, 25)
-                self.drops.append([px, py, vx, vy, life])
-        self.drops = [[x + vx, y + vy, vx, vy, life - 1]
-                      for x, y, vx, vy, life in self.drops if life > 1]
+            rng = PARTICLE_RNG
+            n = max(1, int(8 * self.density))
+            rand_dist = rng.uniform(0, dist, n)
+            pos = np.stack([self.src[0] + ux * rand_dist, self.src[1] + uy * rand_dist], axis=1)
+            vel = np.stack([ux * rng.uniform(3, 5, n) + rng.uniform(-0.8, 0.8, n),
+                            uy * rng.uniform(3, 5, n) + rng.uniform(-0.8, 0.8, n)], axis=1)
+            self.drops.emit(pos, vel, rng.integers(10, 26, n))
+        self.drops.step()
         if self.f > self.frames and not self.drops:
             self.alive = False
         return self.alive
-    def draw(self, surf):
+    def draw(self, surf, alpha: float = 1.0):
         pygame.draw.line(surf, (100, 200, 255), self.src, self.dst, 10)
-        pygame.draw.line(surf, (220, 245, 255), self.src, self.dst, 4)
-        for x, y, _, _, life in self.drops:
-            r = max(1, int(3 * (life / 20)))
-            pygame.draw.circle(surf, (170, 220, 255), (int(x), int(y)), r)
+        if self.passes > 1:
+            pygame.draw.line(surf, (220, 245, 255), self.src, self.dst, 4)
+        n = self.drops.n
+        if n:
+            pos = self.drops.render_pos(alpha)
+            radius = np.maximum(1, (3 * self.drops.life[:n] / 20).astype(int))
+            surf.blits([(STAMPS.circle((170, 220, 255), r), (x - r, y - r))
+                        for (x, y), r in zip(pos.tolist(), radius.tolist())],
+                       doreturn=False)
+
+
+# ====== タイマー（ターン進行） ======
+ENEMY_TURN_DELAY_MS = 600  # プレイヤーの技のあと、敵が動くまでの待ち
+BATTLE_END_DELAY_MS = 800  # 決着の一撃を見せてから結果画面へ移るまでの待ち
+
+class Scheduler:
+    """フレームの経過時間で進むタイマー。after() で登録した処理を期限が来たフレームで呼ぶ（描画は止めない）"""
+    def __init__(self):
+        self.now = 0  # 経過時間（ms）
+        self._events = []  # (期限, 登録順, 処理)
+        self._seq = 0
+
+    def after(self, ms: int, fn):
+        self._seq += 1
+        heapq.heappush(self._events, (self.now + ms, self._seq, fn))
+
+    def update(self, dt_ms: int):
+        self.now += dt_ms
+        while self._events and self._events[0][0] <= self.now:
+            _, _, fn = heapq.heappop(self._events)
+            fn()
+
+    def pending(self) -> bool:
+        return bool(self._events)
+
+    def clear(self):
+        self._events.clear()
+
+
+class FixedStep:
+    """
+    フレームの経過時間を貯めて、1/hz 秒ごとに何コマ進めるかを返す
+    alpha は貯まりの残り（前のコマ→次のコマの割合）で、描画の補間に使う
+    """
+    def __init__(self, hz: int = SIM_HZ, max_steps: int = SIM_MAX_STEPS):
+        self.step_ms = 1000 / hz
+        self.max_steps = max_steps
+        self.acc = 0.0
+        self.alpha = 0.0
+
+    def advance(self, dt_ms: float) -> int:
+        self.acc += dt_ms
+        n = int(self.acc // self.step_ms)
+        self.acc -= n * self.step_ms
+        if n > self.max_steps:
+            # 処理落ちで遅れすぎた分は捨てる（追いつこうとしてさらに遅くなるのを防ぐ）
+            n = self.max_steps
+        self.alpha = self.acc / self.step_ms
+        return n
 
 
 # ====== 統合版バトルシーン ======
-def _load_battle_images():
+BATTLE_SPRITE_SIZE = (200, 200)
+
+def _load_battle_images(size, preloader: AssetPreloader = None):
+    """
+    バトル用画像をサイズ調整済みで返す（ASSETS 経由なので2回目以降はキャッシュヒット）
+    preloader を渡すと先読み中の画像はその完了を待つ（同じファイルを2回デコードしない）
+    """
+    if preloader is not None:
+        preloader.require("battle_bg.png", "player_poke.png", "enemy.png")
     # battle_bg
     try:
-        bg = pygame.image.load("battle_bg.png").convert()
-    except:
-        bg = pygame.Surface((WINDOW_W, WINDOW_H)).convert()
+        bg = ASSETS.get("battle_bg.png", size, alpha=False)
+    except (pygame.error, FileNotFoundError):
+        bg = pygame.Surface(size).convert()
         bg.fill((200, 220, 240))
 
     # player_poke / enemy_poke
@@ -449,8 +2581,8 @@ def _load_battle_images():
         for path in candidates:
             if os.path.exists(path):
                 try:
-                    return pygame.image.load(path).convert_alpha()
-                except:
+                    return atlas_sized(path, BATTLE_SPRITE_SIZE)
+                except pygame.error:
                     pass
         # フォールバック：適当な円
         surf = pygame.Surface((200, 200), pygame.SRCALPHA)
@@ -461,173 +2593,214 @@ def _load_battle_images():
     enemy_poke  = _try_load("enemy.png",  "9.png")
     return bg, player_poke, enemy_poke
 
-def battle_scene(screen, enemy_name: str, enemy_type: str) -> str:
-    """タイプ相性＋高品質エフェクト統合版のバトル"""
-    clock = pygame.time.Clock()
-    W, H = screen.get_size()
-
-    # --- アセット読み込み ---
-    raw_bg, raw_player, raw_enemy = _load_battle_images()
-    bg = pygame.transform.scale(raw_bg, (W, H))
-    player_img = pygame.transform.scale(raw_player, (200, 200))
-    enemy_img = pygame.transform.scale(raw_enemy, (200, 200))
-
-    player_rect = player_img.get_rect(bottomleft=(200, H - 50))
-    enemy_rect = enemy_img.get_rect(topleft=(W - 300, 120))
-
-    effects: List[EffectBase] = []
-    floating: List[FloatingNumber] = []
-
-    player_hp, enemy_hp = 100, 100
-
-    # 技：名前, 基本威力, タイプ, エフェクト種別
-    # エフェクト種別: "tackle", "quick", "flame", "water"
-    commands = [
-        ("たいあたり",   10, "ノーマル", "tackle"),
-        ("かえんほうしゃ", 25, "ほのお",   "flame"),
-        ("でんこうせっか", 18, "でんき",   "quick"),
-        ("みずでっぽう",   20, "みず",     "water"),
-    ]
-    selected = 0
-    turn = "player"
-    message = f"{enemy_name}（{enemy_type}） が あらわれた！"
-    effect_text = None
-    effect_timer = 0
-
-    while True:
-        # --- イベント ---
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit(); sys.exit()
-            elif event.type == pygame.KEYDOWN and turn == "player":
-                if event.key == pygame.K_UP:
-                    selected = (selected - 1) % len(commands)
-                elif event.key == pygame.K_DOWN:
-                    selected = (selected + 1) % len(commands)
-                elif event.key == pygame.K_RETURN:
-                    move, base, mtype, kind = commands[selected]
-                    mult = get_type_multiplier(mtype, enemy_type)
-                    dmg = int(base * mult)
-
-                    # エフェクト生成
-                    if kind == "tackle":
-                        effects.append(TackleEffect(player_rect, player_rect.topleft, enemy_rect.center, frames=10))
-                    else:
-                        src = (player_rect.right - 20, player_rect.top + 40)
-                        dst = (enemy_rect.left + 20, enemy_rect.top + 40)
-                        if kind == "quick":
-                            effects.append(QuickAttackEffect(src, dst))
-                        elif kind == "flame":
-                            effects.append(FlamethrowerEffect(src, dst))
-                        elif kind == "water":
-                            effects.append(WaterGunEffect(src, dst))
-
-                    # ダメージ＆演出
-                    enemy_hp -= dmg
-                    floating.append(FloatingNumber(str(dmg), enemy_rect.midtop))
-                    if mult > 1:
-                        effect_text = "こうかは ばつぐんだ！"
-                        effect_timer = 60
-                    elif mult < 1:
-                        effect_text = "こうかは いまひとつだ…"
-                        effect_timer = 60
-                    else:
-                        effect_text = None
-                    message = f"{move}（{mtype}）！ {dmg}ダメージ！"
-
-                    if enemy_hp <= 0:
-                        return "win"
-                    turn = "enemy"
-
-        # --- 敵ターン ---
-        if turn == "enemy":
-            pygame.time.delay(600)
-            dmg = random.randint(8, 22)
-            player_hp -= dmg
-            message = f"{enemy_name} の こうげき！ {dmg}ダメージ！"
-            floating.append(FloatingNumber(str(dmg), player_rect.midtop))
-            if player_hp <= 0:
-                return "lose"
-            turn = "player"
-
-        # --- 更新 ---
-        floating = [f for f in floating if f.update()]
-        effects = [e for e in effects if e.update()]
-        if effect_text:
-            effect_timer -= 1
-            if effect_timer <= 0:
-                effect_text = None
-
-        # --- 描画 ---
-        temp = pygame.Surface((W, H), pygame.SRCALPHA)
-        temp.blit(bg, (0, 0))
-
-        # キャラ
-        temp.blit(player_img, player_rect)
-        temp.blit(enemy_img, enemy_rect)
+class BattleScene(Scene):
+    """タイプ相性＋高品質エフェクト統合版のバトル（決着すると ResultScene に切り替わる）"""
+    quality_governed = True  # 画質の段はバトルのエフェクトにしか効かないので、バトルのフレームだけで決める
+    def __init__(self, screen: pygame.Surface, enemy_name: str, enemy_type: str, on_done=None,
+                 enemy_type_id: int = None, preloader: AssetPreloader = None):
+        super().__init__()
+        self.enemy_name = enemy_name
+        self.enemy_type = enemy_type
+        self.on_done = on_done  # 結果画面を閉じた時に on_done(result) を呼ぶ
+        self.preloader = preloader
+        W, H = self.size = screen.get_size()
+
+        # --- アセット読み込み ---
+        self.bg, self.player_img, self.enemy_img = _load_battle_images((W, H), preloader)
+
+        self.player_rect = self.player_img.get_rect(bottomleft=(200, H - 50))
+        self.enemy_rect = self.enemy_img.get_rect(topleft=(W - 300, 120))
+
+        self.effects: List[EffectBase] = []
+        self.floating: List[FloatingNumber] = []
+
+        self.engine = BattleEngine(enemy_type, enemy_type_id=enemy_type_id)
+        self.commands = self.engine.moves
+        self.selected = 0
+        self.turn = "player"
+        self.message = f"{enemy_name}（{enemy_type}） が あらわれた！"
+        self.effect_text = None
+        self.effect_timer = 0  # effect_text を出しておく残り時間（ms）
+        # 敵の行動や決着の待ちは pygame.time.delay で止めずにタイマーで予約する
+        self.sched = Scheduler()
+        # エフェクトと浮遊ダメージは一定間隔のコマで進め、描画は補間する
+        self.sim = FixedStep()
+        get_glyph_atlas(QUALITY.tier["antialias"])  # ダメージ表示の数字は最初の一撃の前に用意しておく
+        self.player_prev = self.player_rect.topleft  # たいあたりで動く自キャラの1コマ前の位置
+
+    # --- イベント ---
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN and self.turn == "player":
+            if event.key == pygame.K_UP:
+                self.selected = (self.selected - 1) % len(self.commands)
+            elif event.key == pygame.K_DOWN:
+                self.selected = (self.selected + 1) % len(self.commands)
+            elif event.key == pygame.K_RETURN:
+                self.use_move(self.selected)
+
+    def use_move(self, index: int):
+        move, _, mtype, kind = self.commands[index]
+        dmg, mult = self.engine.player_move(index)
+        player_rect, enemy_rect = self.player_rect, self.enemy_rect
+        tier = QUALITY.tier
+
+        # エフェクト生成（細かさは画質の段に合わせる）
+        if kind == "tackle":
+            self.effects.append(TackleEffect(player_rect, player_rect.topleft, enemy_rect.center, frames=10))
+        else:
+            src = (player_rect.right - 20, player_rect.top + 40)
+            dst = (enemy_rect.left + 20, enemy_rect.top + 40)
+            if kind == "quick":
+                self.effects.append(QuickAttackEffect(src, dst, passes=tier["passes"]))
+            elif kind == "flame":
+                self.effects.append(FlamethrowerEffect(src, dst, density=tier["particles"], smoke=tier["smoke"]))
+            elif kind == "water":
+                self.effects.append(WaterGunEffect(src, dst, density=tier["particles"], passes=tier["passes"]))
+
+        # ダメージ＆演出
+        self.floating.append(FloatingNumber(str(dmg), enemy_rect.midtop, antialias=tier["antialias"]))
+        if mult > 1:
+            self.effect_text = "こうかは ばつぐんだ！"
+            self.effect_timer = EFFECT_TEXT_MS
+        elif mult < 1:
+            self.effect_text = "こうかは いまひとつだ…"
+            self.effect_timer = EFFECT_TEXT_MS
+        else:
+            self.effect_text = None
+        self.message = f"{move}（{mtype}）！ {dmg}ダメージ！"
+
+        if self.engine.result == "win":
+            self.turn = "end"
+            self.sched.after(BATTLE_END_DELAY_MS, lambda: self.finish("win"))
+        else:
+            self.turn = "enemy"
+            self.sched.after(ENEMY_TURN_DELAY_MS, self.enemy_attack)
+
+    # --- 敵ターン ---
+    def enemy_attack(self):
+        dmg = self.engine.enemy_move()
+        self.message = f"{self.enemy_name} の こうげき！ {dmg}ダメージ！"
+        self.floating.append(FloatingNumber(str(dmg), self.player_rect.midtop, antialias=QUALITY.tier["antialias"]))
+        if self.engine.result == "lose":
+            self.turn = "end"
+            self.sched.after(BATTLE_END_DELAY_MS, lambda: self.finish("lose"))
+        else:
+            self.turn = "player"
+
+    def finish(self, result: str):
+        on_close = (lambda: self.on_done(result)) if self.on_done else None
+        self.stack.replace(ResultScene(self.size, result, on_close, self.preloader))
+
+    # --- 更新 ---
+    def update(self, dt: int):
+        self.sched.update(dt)
+        if self.stack is None or self.stack.top is not self:
+            return
+        for _ in range(self.sim.advance(dt)):
+            self.player_prev = self.player_rect.topleft
+            self.floating = [f for f in self.floating if f.update()]
+            effects = []
+            for e in self.effects:
+                with PROFILER.scope(f"effect.{type(e).__name__}.update"):
+                    if e.update():
+                        effects.append(e)
+            self.effects = effects
+        if self.effect_text:
+            self.effect_timer -= dt
+            if self.effect_timer <= 0:
+                self.effect_text = None
+
+    # --- 描画 ---
+    def draw_textures(self, gpu: TextureBackend) -> bool:
+        # 背景・キャラ・文字はテクスチャ、エフェクトだけ透明な面（draw の中で切り替える）
+        self.draw(gpu)
+        return True
+
+    def draw(self, screen: pygame.Surface):
+        W, H = self.size
+        alpha = self.sim.alpha
+        # 画面に直接描く（背景は表示形式なので不透明コピー、アルファはエフェクトだけ）
+        screen.blit(self.bg, (0, 0))
+
+        # キャラ（自キャラはたいあたりで動くのでコマの間を補間）
+        (px, py), (x, y) = self.player_prev, self.player_rect.topleft
+        screen.blit(self.player_img, (round(_lerp(px, x, alpha)), round(_lerp(py, y, alpha))))
+        screen.blit(self.enemy_img, self.enemy_rect)
 
         # HPバー
-        pygame.draw.rect(temp, (255, 0, 0), (80,  H - 260, max(0, player_hp * 2), 20))
-        pygame.draw.rect(temp, (255, 0, 0), (W - 300, 80,   max(0, enemy_hp * 2), 20))
+        screen.fill((255, 0, 0), (80,  H - 260, max(0, self.engine.player_hp * 2), 20))
+        screen.fill((255, 0, 0), (W - 300, 80,   max(0, self.engine.enemy_hp * 2), 20))
 
         # メッセージ
-        draw_text(temp, message, 80, H - 180, 26)
+        draw_text(screen, self.message, 80, H - 180, 26)
 
         # コマンド
-        if turn == "player":
-            for i, (cmd, _, t, _) in enumerate(commands):
-                color = (255, 0, 0) if i == selected else (0, 0, 0)
-                draw_text(temp, f"{cmd}（{t}）", 100, H - 150 + i * 28, 24, color)
+        if self.turn == "player":
+            for i, (cmd, _, t, _) in enumerate(self.commands):
+                color = (255, 0, 0) if i == self.selected else (0, 0, 0)
+                draw_text(screen, f"{cmd}（{t}）", 100, H - 150 + i * 28, 24, color)
 
         # 浮遊ダメージ・エフェクト
-        for f in floating: f.draw(temp)
-        for ef in effects: ef.draw(temp)
+        for f in self.floating: f.draw(screen, alpha)
+        if self.effects:
+            # エフェクトは pygame.draw で描くので、テクスチャ描画では透明な面に描いてから重ねる
+            layer = screen.overlay() if isinstance(screen, TextureBackend) else screen
+            for ef in self.effects:
+                with PROFILER.scope(f"effect.{type(ef).__name__}.draw"):
+                    ef.draw(layer, alpha)
+            if layer is not screen:
+                screen.draw_overlay()
 
         # 効果テキスト
-        if effect_text:
-            draw_text(temp, effect_text, W // 2 - 140, 140, 40, (255, 255, 0))
-
-        screen.blit(temp, (0, 0))
-        pygame.display.flip()
-        clock.tick(60)
+        if self.effect_text:
+            draw_text(screen, self.effect_text, W // 2 - 140, 140, 40, (255, 255, 0), QUALITY.tier["antialias"])
 
 
 # ====== 勝敗演出（上コードの画像版を採用） ======
-def show_result(screen, result: str):
-    W, H = screen.get_size()
-    path = "win.png" if result == "win" else "lose.png"
-    if os.path.exists(path):
-        img = pygame.transform.scale(pygame.image.load(path), (W, H))
-    else:
-        # フォールバック：色背景
-        img = pygame.Surface((W, H))
-        img.fill((30, 160, 80) if result == "win" else (160, 40, 40))
-
-    clock = pygame.time.Clock()
-
-    if result == "win":
-        start = pygame.time.get_ticks()
-        while pygame.time.get_ticks() - start < 2000:
-            for e in pygame.event.get():
-                if e.type == pygame.QUIT:
-                    pygame.quit(); sys.exit()
-            screen.blit(img, (0, 0))
+RESULT_WIN_MS = 2000  # 勝利画面を自動で閉じるまでの時間
+
+class ResultScene(Scene):
+    """勝敗演出：勝ちは RESULT_WIN_MS 後に自動で戻り、負けは Enter で戻る"""
+    def __init__(self, size, result: str, on_close=None, preloader: AssetPreloader = None):
+        super().__init__()
+        W, H = self.size = size
+        self.result = result
+        self.on_close = on_close
+        self.elapsed = 0
+        self.animating = result == "win"  # 負け画面は Enter 待ちの静止画
+        path = "win.png" if result == "win" else "lose.png"
+        if preloader is not None:
+            preloader.require(path)
+        if os.path.exists(path):
+            self.img = ASSETS.get(path, (W, H), alpha=False)
+        else:
+            # フォールバック：色背景
+            self.img = pygame.Surface((W, H))
+            self.img.fill((30, 160, 80) if result == "win" else (160, 40, 40))
+
+    def close(self):
+        self.stack.pop()
+        if self.on_close:
+            self.on_close()
+
+    def handle_event(self, event):
+        # lose時はEnterで戻る
+        if self.result != "win" and event.type == pygame.KEYDOWN and event.key == pygame.K_RETURN:
+            self.close()
+
+    def update(self, dt: int):
+        if self.result == "win":
+            self.elapsed += dt
+            if self.elapsed >= RESULT_WIN_MS:
+                self.close()
+
+    def draw(self, screen: pygame.Surface):
+        W, H = self.size
+        screen.blit(self.img, (0, 0))
+        if self.result == "win":
             draw_text(screen, "WIN!", W//2 - 60, H - 100, 40, (255, 255, 255))
-            pygame.display.flip()
-            clock.tick(30)
-        return
-
-    # lose時はEnterで戻る
-    while True:
-        for e in pygame.event.get():
-            if e.type == pygame.QUIT:
-                pygame.quit(); sys.exit()
-            elif e.type == pygame.KEYDOWN and e.key == pygame.K_RETURN:
-                return
-        screen.blit(img, (0, 0))
-        draw_text(screen, "Enterで戻る", W//2 - 100, H - 100, 30, (255, 255, 255))
-        pygame.display.flip()
-        clock.tick(30)
+        else:
+            draw_text(screen, "Enterで戻る", W//2 - 100, H - 100, 30, (255, 255, 255))
 
 # ===========================
 # モンスタークラス（仮実装）
@@ -650,23 +2823,25 @@ class Monster:
 # ===========================
 # インベントリークラス
 # ===========================
-class Inventory:
+class Inventory(Scene):
     """
     Bキーを押すとインベントリ画面が開き、バッグ、キーアイテム、モンスターの3つのタブが出てくる。
     ポーションを選択すると回復、解毒、異常状態回復の3つが選べ、使う事でその効果をモンスターに与える事ができる。
     モンスタータブではモンスターのHPや状態を確認する事ができる。
+    静止画面なので、キー入力があった時だけ描き直す。
     """
+    animating = False
 
     def __init__(self, screen: pygame.Surface, monster: Monster) -> None:
+        super().__init__()
         self.screen = screen
         self.monster = monster
 
-        self.bg_img = pygame.image.load("インベントリ背景画像.png").convert()
-        self.bg_img = pygame.transform.scale(self.bg_img, (800, 600))
+        self.bg_img = ASSETS.get("インベントリ背景画像.png", (800, 600), alpha=False)
         self.bg_rect = self.bg_img.get_rect(center=(screen.get_width() // 2, screen.get_height() // 2))
 
-        self.font_tab = pygame.font.Font(None, 50)
-        self.font_item = pygame.font.Font(None, 40)
+        self.font_tab = get_font(None, 50)
+        self.font_item = get_font(None, 40)
 
         self.tabs = ["Bag", "Key Items", "Monster"]
         self.items = {
@@ -679,70 +2854,42 @@ class Inventory:
 
     # ==== 共通：メッセージ表示関数 ====
     def show_message(self, text: str, delay=800):
-        """中央下に小さめの黒背景＋白文字でメッセージを表示"""
-        # 背景サイズ（画面幅の7割、縦100px程度）
-        msg_width = int(self.screen.get_width() * 0.7)
-        msg_height = 100
-
-        # 背景の位置（画面中央）
-        msg_x = (self.screen.get_width() - msg_width) // 2
-        msg_y = (self.screen.get_height() - msg_height) // 2
-
-        # 半透明黒背景を作成（より黒く、透明度220/255）
-        overlay = pygame.Surface((msg_width, msg_height), pygame.SRCALPHA)
-        overlay.fill((0, 0, 0, 220))  # ← 透明度を上げることでより黒く
-
-        # テキストを白で描画
-        font = pygame.font.Font(None, 36)
-        text_surface = font.render(text, True, (255, 255, 255))
-        text_rect = text_surface.get_rect(center=(msg_width // 2, msg_height // 2))
-
-        # 背景を描画
-        self.screen.blit(overlay, (msg_x, msg_y))
-        self.screen.blit(text_surface, (msg_x + text_rect.x, msg_y + text_rect.y))
+        """中央に小さめの黒背景＋白文字でメッセージを重ねて表示"""
+        self.stack.push(MessageScene(self.screen.get_size(), text, delay))
 
-        pygame.display.flip()
-        pygame.time.delay(delay)
-
-
-    def open(self) -> None:
+    def on_enter(self) -> None:
         """インベントリ画面を開く"""
         pygame.mixer.music.play(loops = -1)
-        while True:
-            self.draw()
-            pygame.display.flip()
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-
-                elif event.type == pygame.KEYDOWN:
-                    if event.key in [pygame.K_b, pygame.K_ESCAPE]:
-                        pygame.mixer.music.stop()
-                        return
-                    elif event.key == pygame.K_RIGHT:
-                        self.current_tab = (self.current_tab + 1) % len(self.tabs)
-                        self.cursor = 0
-                    elif event.key == pygame.K_LEFT:
-                        self.current_tab = (self.current_tab - 1) % len(self.tabs)
-                        self.cursor = 0
-                    elif event.key == pygame.K_DOWN:
-                        if self.tabs[self.current_tab] in ["Bag", "Key Items"]:
-                            current_items = self.items[self.tabs[self.current_tab]]
-                            if len(current_items) > 1:
-                                self.cursor = (self.cursor + 1) % len(current_items)
-                    elif event.key == pygame.K_UP:
-                        if self.tabs[self.current_tab] in ["Bag", "Key Items"]:
-                            current_items = self.items[self.tabs[self.current_tab]]
-                            if len(current_items) > 1:
-                                self.cursor = (self.cursor - 1) % len(current_items)
-                    elif event.key == pygame.K_RETURN:
-                        self.select_item()
-
-    def draw(self) -> None:
+    def on_exit(self) -> None:
+        pygame.mixer.music.stop()
+
+    def handle_event(self, event) -> None:
+        if event.type == pygame.KEYDOWN:
+            if event.key in [pygame.K_b, pygame.K_ESCAPE]:
+                self.stack.pop()
+            elif event.key == pygame.K_RIGHT:
+                self.current_tab = (self.current_tab + 1) % len(self.tabs)
+                self.cursor = 0
+            elif event.key == pygame.K_LEFT:
+                self.current_tab = (self.current_tab - 1) % len(self.tabs)
+                self.cursor = 0
+            elif event.key == pygame.K_DOWN:
+                if self.tabs[self.current_tab] in ["Bag", "Key Items"]:
+                    current_items = self.items[self.tabs[self.current_tab]]
+                    if len(current_items) > 1:
+                        self.cursor = (self.cursor + 1) % len(current_items)
+            elif event.key == pygame.K_UP:
+                if self.tabs[self.current_tab] in ["Bag", "Key Items"]:
+                    current_items = self.items[self.tabs[self.current_tab]]
+                    if len(current_items) > 1:
+                        self.cursor = (self.cursor - 1) % len(current_items)
+            elif event.key == pygame.K_RETURN:
+                self.select_item()
+
+    def draw(self, screen: pygame.Surface) -> None:
         """インベントリの描画"""
-        self.screen.blit(self.bg_img, self.bg_rect.topleft)
+        screen.blit(self.bg_img, self.bg_rect.topleft)
 
         # タブ描画
         for i, tab in enumerate(self.tabs):
@@ -750,7 +2897,7 @@ class Inventory:
             tab_text = self.font_tab.render(tab, True, color)
             tab_x = self.bg_rect.left + 50 + i * 200
             tab_y = self.bg_rect.top + 20
-            self.screen.blit(tab_text, (tab_x, tab_y))
+            screen.blit(tab_text, (tab_x, tab_y))
 
         # アイテム描画
         if self.tabs[self.current_tab] in ["Bag", "Key Items"]:
@@ -758,14 +2905,14 @@ class Inventory:
             for i, item in enumerate(current_items):
                 color = (255, 255, 255) if i == self.cursor else (150, 150, 150)
                 item_text = self.font_item.render(item, True, color)
-                self.screen.blit(item_text, (self.bg_rect.left + 100, self.bg_rect.top + 100 + i * 50))
+                screen.blit(item_text, (self.bg_rect.left + 100, self.bg_rect.top + 100 + i * 50))
 
         elif self.tabs[self.current_tab] == "Monster":
             m = self.monster
             color = (255, 255, 255)
-            self.screen.blit(self.font_item.render(f"HP: {m.hp}/{m.max_hp}", True, color),
+            screen.blit(self.font_item.render(f"HP: {m.hp}/{m.max_hp}", True, color),
                              (self.bg_rect.left + 50, self.bg_rect.top + 130))
-            self.screen.blit(self.font_item.render(f"Status: {m.status if m.status else 'Normal'}", True, color),
+            screen.blit(self.font_item.render(f"Status: {m.status if m.status else 'Normal'}", True, color),
                              (self.bg_rect.left + 50, self.bg_rect.top + 160))
 
     def select_item(self) -> None:
@@ -774,157 +2921,267 @@ class Inventory:
             current_items = self.items[self.tabs[self.current_tab]]
             selected_item = current_items[self.cursor]
             if selected_item == "Potion":
-                self.potion_select()
+                self.stack.push(PotionSelectScene(self))
             else:
-                self.draw()
                 self.show_message(f"{selected_item} is not implemented yet!", delay=800)
 
-    def potion_select(self) -> None:
-        """ポーション選択と使用（ESC/Bで一段階戻る）"""
-        potions = ["Heal Potion", "Antidote", "Status Heal"]
-        cursor = 0
-        font = pygame.font.Font(None, 40)
 
-        while True:
-            self.screen.blit(self.bg_img, self.bg_rect.topleft)
-            self.draw()
+class PotionSelectScene(Scene):
+    """ポーション選択と使用（ESC/Bで一段階戻る）。インベントリの上に重ねて描く"""
+    opaque = False
+    animating = False
+    POTIONS = ["Heal Potion", "Antidote", "Status Heal"]
 
-            for i, potion in enumerate(potions):
-                color = (255, 255, 255) if i == cursor else (150, 150, 150)
-                self.screen.blit(font.render(potion, True, color),
-                                 (self.bg_rect.left + 300, self.bg_rect.top + 100 + i * 50))
+    def __init__(self, inventory: Inventory) -> None:
+        super().__init__()
+        self.inventory = inventory
+        self.cursor = 0
+        self.font = get_font(None, 40)
+
+    def handle_event(self, event) -> None:
+        if event.type != pygame.KEYDOWN:
+            return
+        potions = self.POTIONS
+        monster = self.inventory.monster
+        if event.key in [pygame.K_ESCAPE, pygame.K_b]:
+            self.stack.pop()
+        elif event.key == pygame.K_RETURN:
+            potion_name = potions[self.cursor]
+            if potion_name == "Heal Potion":
+                monster.heal(50)
+            elif potion_name == "Antidote":
+                if monster.status == "Poison":
+                    monster.status_heal()
+            elif potion_name == "Status Heal":
+                monster.status_heal()
+            self.stack.pop()
+            self.inventory.show_message(f"Used {potion_name}", delay=800)
+        elif event.key == pygame.K_UP:
+            self.cursor = (self.cursor - 1) % len(potions)
+        elif event.key == pygame.K_DOWN:
+            self.cursor = (self.cursor + 1) % len(potions)
+
+    def draw(self, screen: pygame.Surface) -> None:
+        bg_rect = self.inventory.bg_rect
+        for i, potion in enumerate(self.POTIONS):
+            color = (255, 255, 255) if i == self.cursor else (150, 150, 150)
+            screen.blit(self.font.render(potion, True, color),
+                        (bg_rect.left + 300, bg_rect.top + 100 + i * 50))
+
+
+class MessageScene(Scene):
+    """下の画面に半透明の黒背景＋白文字のメッセージを重ね、delay ms 後に自動で閉じる"""
+    opaque = False
+
+    def __init__(self, screen_size, text: str, delay: int = 800) -> None:
+        super().__init__()
+        self.delay = delay
+        self.elapsed = 0
+        sw, sh = screen_size
 
-            pygame.display.flip()
+        # 背景サイズ（画面幅の7割、縦100px程度）
+        msg_width = int(sw * 0.7)
+        msg_height = 100
 
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.quit()
-                    sys.exit()
-
-                elif event.type == pygame.KEYDOWN:
-                    if event.key in [pygame.K_ESCAPE, pygame.K_b]:
-                        return
-                    elif event.key == pygame.K_RETURN:
-                        potion_name = potions[cursor]
-                        if potion_name == "Heal Potion":
-                            self.monster.heal(50)
-                        elif potion_name == "Antidote":
-                            if self.monster.status == "Poison":
-                                self.monster.status_heal()
-                        elif potion_name == "Status Heal":
-                            self.monster.status_heal()
-                        self.draw()
-                        self.show_message(f"Used {potion_name}", delay=800)
-                        return
-                    elif event.key == pygame.K_UP:
-                        cursor = (cursor - 1) % len(potions)
-                    elif event.key == pygame.K_DOWN:
-                        cursor = (cursor + 1) % len(potions)
+        # 背景の位置（画面中央）
+        self.pos = ((sw - msg_width) // 2, (sh - msg_height) // 2)
+
+        # 半透明黒背景を作成（より黒く、透明度220/255）
+        self.overlay = pygame.Surface((msg_width, msg_height), pygame.SRCALPHA)
+        self.overlay.fill((0, 0, 0, 220))  # ← 透明度を上げることでより黒く
+
+        # テキストを白で描画
+        text_surface = get_font(None, 36).render(text, True, (255, 255, 255))
+        self.overlay.blit(text_surface, text_surface.get_rect(center=(msg_width // 2, msg_height // 2)))
+
+    def update(self, dt: int) -> None:
+        self.elapsed += dt
+        if self.elapsed >= self.delay:
+            self.stack.pop()
+
+    def draw(self, screen: pygame.Surface) -> None:
+        screen.blit(self.overlay, self.pos)
 
 
 # ====== ゲーム全体（上コードをベースに統合） ======
-class Game:
-    def __init__(self):
+class Game(Scene):
+    """タイトル → タマゴ → マップ → クリア の土台シーン。バトル/インベントリ/ペットはこの上に積む"""
+    def __init__(self, renderer: str = None):
+        super().__init__()
         pygame.init()
-        self.screen = pygame.display.set_mode((WINDOW_W, WINDOW_H))
-        pygame.display.set_caption("ポケットコウカトン")
-        self.clock = pygame.time.Clock()
+        self.backend = create_backend((WINDOW_W, WINDOW_H), "ポケットコウカトン", renderer)
+        self.screen = self.backend.screen
 
         self.monster = Monster("こうかとん", 100)
         self.monster.status = "Poison"
-        self.inventory = Inventory(self.screen, self.monster)
-        pygame.mixer.music.load("poke_center.wav")  # BGMファイル読み込み
 
         # 状態
         self.mode = MODE_TITLE
         self.egg_phase = 0
-        self.pink_mode = False
-
-        # 背景
-        self.bg_img = pygame.image.load("background.png").convert()
-        self.bg_rect = self.bg_img.get_rect()
-
-        # 各キャラ/シーン
-        self.player = Player(self.bg_rect)
-        self.egg = Egg(self.bg_rect)
-        self.partner = Partner("Koukaton")
-        self.bosses = BossGroup()
-        self.pet_scene = PetScene("こうかとん", self.screen)
-
-        # 上限判定
-        if USE_MANUAL_TOP_LIMIT:
-            self.top_limit = MANUAL_TOP_Y
-        else:
-            auto_top = detect_top_walkable_y(self.bg_img)
-            self.top_limit = max(0, auto_top + TOP_LIMIT_OFFSET)
+        # 差分矩形は display.update を使うので software のときだけ
+        self.dirty = (DirtyRectRenderer(self.screen.get_size())
+                      if USE_DIRTY_RECTS and self.backend.name == "software" else None)
+
+        # タイトル画面はすぐ表示し、残りのアセットは裏で先読みする（使う直前に require で待つ）
+        self.preloader = AssetPreloader()
+        self._start_preload()
+        self.world_map = self.camera = None
+        self.player = self.egg = self.partner = self.bosses = None
+        self.map_renderer = self.walk_map = None
+        self.pet_scene = self.inventory = None
+        self.sim = FixedStep()  # フィールドの歩き
+
+        # メインループは SceneStack が1本だけ持つ
+        SceneStack(self.screen, backend=self.backend).push(self)
+
+    @property
+    def animating(self) -> bool:
+        # マップ以外（タイトル/セレクト/クリア）は静止画なので入力待ちで眠る
+        return self.mode == MODE_PLAY
+
+    def _start_preload(self):
+        p = self.preloader
+        p.add("map", lambda: ChunkedMap.open("background.png"))
+        p.add_scaled("egg.png", 0.35)
+        p.add_image("3.png")
+        for path in ("player_down.png", "player_side_left.png"):
+            p.add_scaled(path, 0.1)
+        for path, scale in (("boss_yellow.png", 0.2), ("boss_red.png", 0.2), ("boss_white.png", 0.18)):
+            p.add_scaled(path, scale)
+        if USE_WALKABILITY:
+            p.add("walk_map", lambda: WalkabilityMap.load("background.png"))
+        for name in ("1.png", "9.png", "7.png", "8.png"):
+            p.add_image(os.path.join("こうかとん", name))
+        p.add_image("インベントリ背景画像.png", alpha=False, size=(800, 600))
+        p.add("poke_center.wav", lambda: open("poke_center.wav", "rb").read(),
+              lambda data: pygame.mixer.music.load(io.BytesIO(data)))  # BGMファイル読み込み
+        # バトル用は BattleScene / ResultScene で使う大きさまで作っておく（元の大きさのデコードは残さない）
+        size = self.screen.get_size()
+        for path in ("battle_bg.png", "win.png"):
+            if os.path.exists(path):
+                p.add_image(path, alpha=False, size=size)
+        for path in ("player_poke.png", "enemy.png"):
+            if os.path.exists(path):
+                p.add_image(path, make=lambda path=path: atlas_sized(path, BATTLE_SPRITE_SIZE))
+        p.start()
 
-    def run(self):
-        while True:# 以下追加コード
-            self.handle_events()
-            if self.pink_mode:
-                self.pet_scene.update()
-                self.pet_scene.draw()
-            else:
-                self.update()
-                self.draw()
-            pygame.display.flip()
-            self.clock.tick(60)
+    def ensure_assets(self):
+        """今のモードで必要なアセットだけ待って、まだ作っていないキャラ/シーンを作る"""
+        p = self.preloader
+        p.pump()
+        if self.mode == MODE_TITLE:
+            return
+        if self.egg is None:
+            p.require("egg.png", "3.png")
+            self.egg = Egg(self.screen.get_rect())
+            self.partner = Partner("Koukaton")
+        if self.mode in (MODE_PLAY, MODE_CLEAR) and self.player is None:
+            p.require("player_down.png", "player_side_left.png",
+                      "boss_yellow.png", "boss_red.png", "boss_white.png")
+            self.world_map, = p.require("map")
+            self.player = Player(self.world_map.world_rect)
+            self.camera = Camera(self.screen.get_size(), self.world_map.world_rect)
+            self.camera.follow(self.player.rect)
+            self.bosses = BossGroup()
+            self.map_renderer = MapRenderer(self.world_map)
+            # 歩行判定
+            self.walk_map = p.require("walk_map")[0] if USE_WALKABILITY else None
+
+    def open_inventory(self):
+        if self.inventory is None:
+            self.preloader.require("インベントリ背景画像.png", "poke_center.wav")
+            self.inventory = Inventory(self.screen, self.monster)
+        self.stack.push(self.inventory)
+
+    def open_pet(self):
+        if self.pet_scene is None:
+            self.preloader.require(*(os.path.join("こうかとん", n) for n in ("1.png", "9.png", "7.png", "8.png")))
+            self.pet_scene = PetScene("こうかとん", self.screen, open_inventory=self.open_inventory)
+        self.stack.push(self.pet_scene)
 
-    def handle_events(self):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                pygame.quit(); sys.exit()
+    def run(self):
+        self.stack.run()
 
-            if event.type == pygame.KEYDOWN:
-                # ペットモード切替（どのモードからでも）
-                if event.key == pygame.K_f:
-                    self.pink_mode = not self.pink_mode
-                    continue
+    def on_resume(self):
+        # 上に積んだシーンが画面を描き換えているので全画面から描き直す
+        if self.dirty:
+            self.dirty.invalidate()
 
-                # Bキーでインベントリを開く
-                if event.type == pygame.KEYDOWN and event.key == pygame.K_b:
-                    self.inventory.open()
+    def handle_event(self, event):
+        if event.type == pygame.KEYDOWN:
+            # ペットモード（どのモードからでも）
+            if event.key == pygame.K_f:
+                self.open_pet()
+                return
 
-                # ペットモード中の操作
-                if self.pink_mode:
-                    self.pet_scene.handle_event(event)
-                    continue
+            # Bキーでインベントリを開く
+            if event.key == pygame.K_b:
+                self.open_inventory()
+                return
 
-                # 各モードのハンドリング
-                if self.mode == MODE_TITLE:
-                    if event.key == pygame.K_RETURN:
-                        self.mode = MODE_SELECT
+            # 各モードのハンドリング
+            if self.mode == MODE_TITLE:
+                if event.key == pygame.K_RETURN:
+                    self.mode = MODE_SELECT
 
-                elif self.mode == MODE_SELECT:
-                    if event.key == pygame.K_RETURN:
-                        if self.egg_phase == 0:
-                            self.egg_phase = 1  # 孵化
-                        else:
-                            self.mode = MODE_PLAY
+            elif self.mode == MODE_SELECT:
+                if event.key == pygame.K_RETURN:
+                    if self.egg_phase == 0:
+                        self.egg_phase = 1  # 孵化
+                    else:
+                        self.mode = MODE_PLAY
 
-                elif self.mode == MODE_CLEAR:
-                    if event.key == pygame.K_RETURN:
-                        pygame.quit(); sys.exit()
+            elif self.mode == MODE_CLEAR:
+                if event.key == pygame.K_RETURN:
+                    self.stack.quit()
 
-    def update(self):
+    def update(self, dt: int):
+        self.ensure_assets()
         if self.mode == MODE_PLAY:
-            keys = pygame.key.get_pressed()
-            self.player.update(keys, self.top_limit)
-
-            # ボス衝突でバトル開始（→統合版battle_scene使用）
-            collided = self.bosses.alive_collision_with(self.player.rect)
-            if collided:
-                result = battle_scene(self.screen, collided.name, collided.type)
-                show_result(self.screen, result)
-                if result == "win":
-                    # 勝利 → 該当ボス撃破 → クリア画面へ（仕様：ボス倒したら終了）
-                    collided.alive = False
-                    self.mode = MODE_CLEAR
-                else:
-                    # 敗北 → マップに戻り、プレイヤー初期位置へ
-                    self.player.rect.topleft = (465, 600)
+            # 歩きは一定間隔のコマで進め、描画（とカメラ）はコマの間を補間した位置に置く
+            for _ in range(self.sim.advance(dt)):
+                self.player.update(self.stack.keys, self.walk_map)
+
+                # ボス衝突でバトル開始（結果画面を閉じたら after_battle）
+                collided = self.bosses.alive_collision_with(self.player.rect)
+                if collided:
+                    self.player.prev_topleft = self.player.rect.topleft
+                    self.stack.push(BattleScene(self.screen, collided.name, collided.type,
+                                                on_done=lambda result, boss=collided: self.after_battle(boss, result),
+                                                enemy_type_id=collided.type_id, preloader=self.preloader))
+                    break
+            self.player.alpha = self.sim.alpha
+            self.camera.follow(self.player.render_rect())
+
+    def after_battle(self, boss: Boss, result: str):
+        if result == "win":
+            # 勝利 → 該当ボス撃破 → クリア画面へ（仕様：ボス倒したら終了）
+            boss.alive = False
+            self.mode = MODE_CLEAR
+        else:
+            # 敗北 → マップに戻り、プレイヤー初期位置へ
+            self.player.place(PLAYER_START)
+            self.camera.follow(self.player.rect)
+
+    def present(self, screen: pygame.Surface) -> bool:
+        if self.dirty:
+            self.draw_dirty()
+            return True
+        return False
+
+    def draw_textures(self, gpu: TextureBackend) -> bool:
+        if self.mode != MODE_PLAY:
+            return False  # 静止画の画面は screen に描いて送る
+        # チャンク・ボス・プレイヤーはテクスチャのまま重ねる（静的レイヤーへの合成はいらない）
+        cam = self.camera
+        self.world_map.draw(gpu, cam)
+        for b in self.bosses.visible(cam):
+            b.draw(gpu, cam)
+        gpu.blit(render_text(MAP_HINT_TEXT, 24, (255, 255, 0)), (10, 10))
+        self.player.draw(gpu, cam)
+        return True
 
-    def draw(self):
+    def draw(self, screen: pygame.Surface):
         if self.mode == MODE_TITLE:
             self.draw_title()
         elif self.mode == MODE_SELECT:
@@ -934,11 +3191,39 @@ class Game:
         elif self.mode == MODE_CLEAR:
             self.draw_clear()
 
+    def draw_dirty(self):
+        """差分矩形モードの描画。変化のない静止画面は描画もスキップする"""
+        d = self.dirty
+        d.begin((self.mode, self.egg_phase))
+        if self.mode == MODE_PLAY:
+            cam = self.camera
+            layer = self.map_renderer.static_layer(self.screen.get_size(), cam, self.bosses)
+            # カメラが動いたら画面全体が変わる（レイヤーはスクロールして端だけ描き足すので作り直しにはならない）
+            d.track("camera", self.screen.get_rect(), cam.rect.topleft)
+            d.track("player", cam.to_screen(self.player.render_rect()), id(self.player.image))
+            for b in self.bosses.visible(cam):
+                d.track(("boss", id(b)), cam.to_screen(b.rect))
+            hud_rect = render_text(MAP_HINT_TEXT, 24, (255, 255, 0)).get_rect(topleft=(10, 10))
+            d.track("hud", hud_rect, MAP_HINT_TEXT)
+            if d.needs_full():
+                self.draw_play()
+            elif d.dirty_rects():
+                # 変化した矩形を静的レイヤーで塗り直してから HUD とプレイヤーを描く
+                # HUD とプレイヤーは毎回まるごと描くので、その下も塗り直す（半透明の縁が重なって濃くならないように）
+                player_rect = cam.to_screen(self.player.render_rect())
+                for r in d.dirty_rects() + [hud_rect, player_rect]:
+                    self.screen.blit(layer, r, r)
+                self.map_renderer.draw_hud(self.screen)
+                self.player.draw(self.screen, cam)
+        elif d.needs_full():
+            self.draw(self.screen)
+        d.present()
+
     def draw_title(self):
         self.screen.fill((0, 0, 0))
-        t1 = get_jp_font(64).render("The Chamber of Beginnings", True, (255, 255, 0))
-        t2 = get_jp_font(40).render("Press ENTER", True, (255, 255, 255))
-        t3 = get_jp_font(28).render("A mysterious egg awaits...", True, (180, 180, 180))
+        t1 = render_text("The Chamber of Beginnings", 64, (255, 255, 0))
+        t2 = render_text("Press ENTER", 40, (255, 255, 255))
+        t3 = render_text("A mysterious egg awaits...", 28, (180, 180, 180))
         cx = WINDOW_W // 2
         self.screen.blit(t1, (cx - t1.get_width()//2, 200))
         self.screen.blit(t2, (cx - t2.get_width()//2, 280))
@@ -948,28 +3233,23 @@ class Game:
         self.screen.fill((10, 10, 30))
         cx, cy = WINDOW_W // 2, WINDOW_H // 2
         if self.egg_phase == 0:
-            title = get_jp_font(40).render("A mysterious egg appeared...", True, (255, 255, 255))
+            title = render_text("A mysterious egg appeared...", 40, (255, 255, 255))
             self.screen.blit(title, (cx - title.get_width()//2, 80))
             self.egg.draw(self.screen)
-            guide = get_jp_font(28).render("Press ENTER to hatch the egg!", True, (255, 255, 255))
+            guide = render_text("Press ENTER to hatch the egg!", 28, (255, 255, 255))
             self.screen.blit(guide, (cx - guide.get_width()//2, WINDOW_H - 100))
         else:
-            title = get_jp_font(40).render("The egg hatched!", True, (255, 255, 255))
+            title = render_text("The egg hatched!", 40, (255, 255, 255))
             self.screen.blit(title, (cx - title.get_width()//2, 60))
-            sub = get_jp_font(28).render(f"Your partner is {self.partner.name}.", True, (255, 215, 0))
+            sub = render_text(f"Your partner is {self.partner.name}.", 28, (255, 215, 0))
             self.screen.blit(sub, (cx - sub.get_width()//2, 110))
             self.partner.draw_center(self.screen, (cx, cy + 40))
-            guide = get_jp_font(28).render("Press ENTER to start your journey!", True, (255, 255, 255))
+            guide = render_text("Press ENTER to start your journey!", 28, (255, 255, 255))
             self.screen.blit(guide, (cx - guide.get_width()//2, WINDOW_H - 100))
 
     def draw_play(self):
-        # 背景は画面に合わせてスケールして描画
-        bg_scaled = pygame.transform.scale(self.bg_img, (WINDOW_W, WINDOW_H))
-        self.screen.blit(bg_scaled, (0, 0))
-        self.bosses.draw(self.screen)
-        self.player.draw(self.screen)
-        info = get_jp_font(24).render("F: ペットモード / ボスに触れるとバトル", True, (255, 255, 0))
-        self.screen.blit(info, (10, 10))
+        # 背景・ボス・HUD はキャッシュ済みレイヤーを1回blit、動くのはプレイヤーだけ
+        self.map_renderer.draw(self.screen, self.camera, self.bosses, self.player)
 
     def draw_clear(self):
         self.screen.fill((20, 80, 90))
@@ -980,20 +3260,39 @@ class Game:
         for (sx, sy) in [(200,200),(300,150),(500,180),(600,240),(250,260),(450,120)]:
             pygame.draw.circle(self.screen, star_color, (sx, sy), 4)
             pygame.draw.circle(self.screen, star_color, (sx+8, sy+4), 2)
-        line_top = get_jp_font(48).render("You are the Champion.", True, (255, 215, 0))
+        line_top = render_text("You are the Champion.", 48, (255, 215, 0))
         self.screen.blit(line_top, (cx - line_top.get_width()//2, 80))
-        line_name = get_jp_font(28).render(f"Your partner is {self.partner.name}!", True, (255, 255, 255))
+        line_name = render_text(f"Your partner is {self.partner.name}!", 28, (255, 255, 255))
         self.screen.blit(line_name, (cx - line_name.get_width()//2, 130))
         party_y = cy + 40
         self.partner.draw_midbottom(self.screen, (cx - 80, party_y))
         hero_rect = self.player.image.get_rect()
         hero_rect.midbottom = (cx + 40, party_y)
         self.screen.blit(self.player.image, hero_rect)
-        line_press = get_jp_font(36).render("Press ENTER to finish", True, (255, 255, 255))
+        line_press = render_text("Press ENTER to finish", 36, (255, 255, 255))
         self.screen.blit(line_press, (cx - line_press.get_width()//2, party_y + 40))
 
 # ===== 実行部分 =====
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="The Chamber of Beginnings")
+    parser.add_argument("--record", metavar="PATH", help="入力と乱数の種をバイナリログに記録する")
+    parser.add_argument("--replay", metavar="PATH", help="記録したログの入力で動かす（既定は待ち時間なしの最速）")
+    parser.add_argument("--realtime", action="store_true", help="--replay を記録した時と同じ速さで再生する")
+    parser.add_argument("--seed", type=int, help="乱数の種（--record ではログに残る）")
+    parser.add_argument("--renderer", choices=("software", "texture"),
+                        help="描画バックエンド（texture は GPU の Renderer が作れなければ software に戻る）")
+    args = parser.parse_args(argv)
+
+    game = Game(renderer=args.renderer)
+    if args.replay:
+        game.stack.play(args.replay, realtime=args.realtime)
+    elif args.record:
+        game.stack.record(args.record, seed=args.seed)
+    elif args.seed is not None:
+        seed_rngs(args.seed)
+    game.run()
+
+
 if __name__ == "__main__":
-    
-    Game().run()
+    main()
     
\ No newline at end of file
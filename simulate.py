@@ -0,0 +1,168 @@
+# simulate.py
+"""
+バトルのモンテカルロシミュレーション（ウィンドウは開かない）
+ボスのタイプ × 技の選び方ごとに大量のバトルを NumPy でまとめて回し、勝率と決着ターン数の分布を出す
+実行: python simulate.py [-n 1000000] [--seed 0] [--json] [--scalar 10000]
+      [--types types.json] [--moves moves.json]（相性表・技表を差し替える）
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import poke
+
+CHUNK = 1 << 20  # 一度に回すバトル数（メモリ使用量の上限）
+
+
+# ====== 技の選び方 ======
+def policies(moves: poke.MoveTable, damages) -> dict:
+    """
+    名前 -> (ベクトル版, 1戦版)
+    ベクトル版: choose(rng, n, turns) が (n, turns) の技番号を返す（int なら毎ターンその技）
+    1戦版: policy(engine) が技番号を返す（BattleEngine.play に渡す）
+    """
+    n_moves = len(moves)
+    table = {}
+    for i, name in enumerate(moves.names):
+        table[name] = (i, lambda e, i=i: i)
+    table["ランダム"] = (
+        lambda rng, n, turns: rng.integers(0, n_moves, size=(n, turns)),
+        lambda e: e.rng.randrange(n_moves),
+    )
+    best = int(np.argmax(damages))
+    table["いちばん強い技"] = (best, lambda e: best)
+    return table
+
+
+# ====== ベクトル化したシミュレーション ======
+def simulate_vectorized(damages: np.ndarray, choose, n: int, rng: np.random.Generator) -> dict:
+    """
+    BattleEngine と同じ規則で n 戦をまとめて回す（プレイヤーが先攻、HP が 0 以下で決着）
+    damages は相手1体に対する技ごとのダメージ（MoveTable.damage_table の1列）
+    """
+    damages = np.asarray(damages, dtype=np.int32)
+    lo, hi = poke.ENEMY_DAMAGE_RANGE
+    hp = poke.BATTLE_MAX_HP
+    # 敵は毎ターン最低 lo ダメージ与えるので、どのバトルもこのターン数までに決着する
+    max_turns = math.ceil(hp / lo)
+    # ダメージの累計は int32 で数える（--moves / --types で大きな値を読んでも黙ってあふれないように確かめる）
+    limit = np.iinfo(np.int32).max
+    if max(int(damages.max()), hi) * max_turns > limit:
+        raise ValueError(f"ダメージが大きすぎます（最大 {max(int(damages.max()), hi)} × {max_turns} ターンが "
+                         f"{limit} を超える）。技表・相性表の値を確かめてください")
+
+    wins = 0
+    turn_counts = {"win": np.zeros(max_turns + 1, np.int64), "lose": np.zeros(max_turns + 1, np.int64)}
+    done = 0
+    while done < n:
+        m = min(CHUNK, n - done)
+        if callable(choose):
+            player = damages[choose(rng, m, max_turns)]
+        else:
+            player = np.broadcast_to(damages[choose], (m, max_turns))
+        enemy = rng.integers(lo, hi + 1, size=(m, max_turns), dtype=np.int32)
+        # 何ターン目（0始まり）で相手の HP が尽きるか。尽きなければ max_turns
+        p_hit = np.cumsum(player, axis=1, dtype=np.int32) >= hp
+        e_hit = np.cumsum(enemy, axis=1, dtype=np.int32) >= hp
+        win_turn = np.where(p_hit.any(axis=1), p_hit.argmax(axis=1), max_turns)
+        lose_turn = np.where(e_hit.any(axis=1), e_hit.argmax(axis=1), max_turns)
+        won = win_turn <= lose_turn  # 同じターンならプレイヤーの攻撃が先
+        turns = np.minimum(win_turn, lose_turn) + 1
+        wins += int(won.sum())
+        turn_counts["win"] += np.bincount(turns[won], minlength=max_turns + 1)
+        turn_counts["lose"] += np.bincount(turns[~won], minlength=max_turns + 1)
+        done += m
+    return _summary(n, wins, turn_counts)
+
+
+def simulate_scalar(enemy_type: str, moves: poke.MoveTable, policy, n: int, seed: int) -> dict:
+    """BattleEngine を1戦ずつ回す（ベクトル版の検算用。遅い）"""
+    rng = random.Random(seed)
+    lo = poke.ENEMY_DAMAGE_RANGE[0]
+    max_turns = math.ceil(poke.BATTLE_MAX_HP / lo)
+    wins = 0
+    turn_counts = {"win": np.zeros(max_turns + 1, np.int64), "lose": np.zeros(max_turns + 1, np.int64)}
+    for _ in range(n):
+        engine = poke.BattleEngine(enemy_type, rng=rng, moves=moves)
+        result = engine.play(policy)
+        wins += result == "win"
+        turn_counts[result][engine.turns] += 1
+    return _summary(n, wins, turn_counts)
+
+
+def _summary(n: int, wins: int, turn_counts: dict) -> dict:
+    total = turn_counts["win"] + turn_counts["lose"]
+    turns = np.arange(len(total))
+    cdf = np.cumsum(total) / max(1, n)
+    return {
+        "battles": n,
+        "win_rate": wins / max(1, n),
+        "mean_turns": float((turns * total).sum() / max(1, n)),
+        "p50_turns": int(np.searchsorted(cdf, 0.5)),
+        "p95_turns": int(np.searchsorted(cdf, 0.95)),
+        # 決着ターン数 -> 戦数（0 のターンは省く）
+        "turns": {
+            result: {int(t): int(c) for t, c in enumerate(counts) if c}
+            for result, counts in turn_counts.items()
+        },
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="バトルのモンテカルロシミュレーション")
+    parser.add_argument("-n", "--battles", type=int, default=1_000_000, help="組み合わせごとのバトル数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    parser.add_argument("--scalar", type=int, default=0, metavar="N",
+                        help="BattleEngine を1戦ずつ N 戦回した結果も並べる（検算用）")
+    parser.add_argument("--types", metavar="PATH", help="相性表の JSON（{攻撃側: {防御側: 倍率}}）")
+    parser.add_argument("--moves", metavar="PATH", help="技表の JSON（[[名前, 威力, タイプ, 種別], ...]）")
+    args = parser.parse_args(argv)
+
+    chart = poke.TypeChart.load(args.types) if args.types else poke.TYPE_CHART
+    moves = poke.MoveTable.load(args.moves, chart) if args.moves else poke.MoveTable(poke.BATTLE_MOVES, chart)
+    bosses = [(name, type_) for name, _, type_, *_ in poke.BOSS_SPECS]
+    # 全ボス×全技のダメージを一度に計算する
+    table = moves.damage_table(chart.ids(type_ for _, type_ in bosses))
+
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    t0 = time.perf_counter()
+    for j, (boss_name, boss_type) in enumerate(bosses):
+        damages = table[:, j]
+        for policy_name, (choose, policy) in policies(moves, damages).items():
+            key = f"{boss_name}（{boss_type}）/ {policy_name}"
+            try:
+                results[key] = simulate_vectorized(damages, choose, args.battles, rng)
+            except ValueError as e:
+                parser.error(str(e))
+            if args.scalar:
+                results[key]["scalar"] = simulate_scalar(boss_type, moves, policy, args.scalar, args.seed)
+    elapsed = time.perf_counter() - t0
+
+    if args.json:
+        json.dump({"elapsed_s": elapsed, "results": results}, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return
+    for key, r in results.items():
+        print(f"{key}: 勝率 {r['win_rate'] * 100:6.2f}%  平均 {r['mean_turns']:.2f}ターン"
+              f"  p50 {r['p50_turns']}  p95 {r['p95_turns']}")
+        for result in ("win", "lose"):
+            dist = "  ".join(f"{t}:{c}" for t, c in r["turns"][result].items())
+            print(f"    {result:4s} {dist}")
+        if "scalar" in r:
+            print(f"    検算（1戦ずつ {r['scalar']['battles']} 戦）: 勝率 {r['scalar']['win_rate'] * 100:6.2f}%"
+                  f"  平均 {r['scalar']['mean_turns']:.2f}ターン")
+    total = args.battles * len(results)
+    print(f"{total} 戦 / {elapsed:.2f} 秒")
+
+
+if __name__ == "__main__":
+    main()